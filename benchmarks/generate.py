@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+""" Synthetic bcbio RNA-seq outputs for the benchmarks, at a given scale.
+
+    python benchmarks/generate.py <out_dir> [--genes N] [--samples N] [--contrasts N]
+                                            [--pathways N] [--nodes N] [--pca-samples N]
+                                            [--cohort-samples N]
+
+Writes, under out_dir:
+    qc/   rawCounts.csv, normalizedCounts.csv, tpm.csv, corMatrix.csv, pca.csv, gene2biotype.csv
+    de/<contrast>/de_gene_key.csv
+    fa/<contrast>/pathway_table.csv, <pathway>_pathway.csv, <pathway>.xml
+    az/   pca_data.txt.gz, ngs_report_by_sample.tsv, gender_by_sample.json
+Everything is seeded, so the same parameters always give the same files. """
+
+import os
+import gzip
+import json
+import argparse
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+
+biotypes = ['protein_coding', 'lincRNA', 'antisense', 'processed_pseudogene', 'unprocessed_pseudogene',
+            'miRNA', 'snRNA', 'misc_RNA', 'snoRNA', 'sense_intronic']
+biotype_weights = [0.55, 0.1, 0.09, 0.08, 0.05, 0.05, 0.03, 0.03, 0.01, 0.01]
+covariates = ['condition', 'batch', 'rin', 'sex', 'age', 'library_size']
+
+
+def gene_ids(n):
+    return ['ENSG{:011d}'.format(i) for i in range(n)]
+
+
+def sample_names(n):
+    return ['S{}'.format(i) for i in range(n)]
+
+
+def conditions(n, rng):
+    return rng.choice(['control', 'treated', 'knockdown', 'rescue'], n)
+
+
+def gen_qc(out_dir, genes, samples, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    gene_index = pd.Index(gene_ids(genes), name='gene')
+    names = sample_names(samples)
+
+    # negative binomial counts around log-normal gene means, ~10% of the genes not expressed
+    means = np.exp(rng.normal(4, 2, genes)) * (rng.random(genes) > 0.1)
+    size_factors = rng.uniform(0.5, 1.5, samples)
+    counts = rng.negative_binomial(5, 5 / (5 + np.outer(means, size_factors) + 1e-9))
+    pd.DataFrame(counts, index=gene_index, columns=names).to_csv(join(out_dir, 'rawCounts.csv'))
+    pd.DataFrame(np.round(counts / size_factors, 2), index=gene_index, columns=names) \
+        .to_csv(join(out_dir, 'normalizedCounts.csv'))
+
+    lengths = rng.integers(500, 10000, genes)
+    rpk = counts / lengths[:, None]
+    tpm = rpk / rpk.sum(axis=0) * 1e6
+    pd.DataFrame(tpm, index=gene_index, columns=names).to_csv(join(out_dir, 'tpm.csv'))
+
+    biotype = pd.DataFrame({'gene_biotype': rng.choice(biotypes, genes, p=biotype_weights)},
+                           index=pd.Index(gene_index, name='ensgene'))
+    # a few genes missing from the annotation
+    biotype.iloc[:int(genes * 0.98)].to_csv(join(out_dir, 'gene2biotype.csv'))
+
+    pcs = rng.normal(0, 1, (samples, 5)) * [20, 10, 5, 3, 2]
+    pca = pd.DataFrame(pcs, index=names, columns=['pc1', 'pc2', 'pc3', 'pc4', 'pc5'])
+    pca['group'] = 'group'
+    pca['condition'] = conditions(samples, rng)
+    pca['name'] = names
+    pca.to_csv(join(out_dir, 'pca.csv'))
+
+    rows = [{'compare': 'PC{}'.format(pc + 1), 'covar': covar, 'r': rng.uniform(-1, 1),
+             'pvalue': rng.random(), 'fdr': rng.random() * 0.3}
+            for covar in covariates for pc in range(3)]
+    pd.DataFrame(rows, columns=['compare', 'covar', 'r', 'pvalue', 'fdr']).to_csv(join(out_dir, 'corMatrix.csv'), index=False)
+
+
+def gen_de(out_dir, genes, contrasts, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = gene_ids(genes)
+    for c in range(contrasts):
+        contrast_dir = join(out_dir, 'contrast_{}'.format(c))
+        os.makedirs(contrast_dir, exist_ok=True)
+        lfc = rng.normal(0, 0.6, genes)
+        # -log10 p-values, strongest for the genes with the largest fold changes
+        p = -np.log10(np.clip(rng.random(genes) ** (1 + 8 * np.abs(lfc)), 1e-300, 1))
+        pd.DataFrame({
+            'gene_id': ids,
+            'gene': ['GENE{}'.format(i) for i in range(genes)],
+            'baseMean': np.exp(rng.normal(4, 2, genes)),
+            'lfc': lfc,
+            'lfc_un': lfc * rng.uniform(1, 1.5, genes),
+            'p': p,
+            'padj': np.maximum(p - np.log10(genes) / 4, 0),
+        }).to_csv(join(contrast_dir, 'de_gene_key.csv'), index=False)
+
+
+def kegg_xml(pathway, nodes, rng):
+    xml = ['<?xml version="1.0"?>', '<pathway name="path:{}" org="hsa">'.format(pathway)]
+    for i in range(nodes):
+        xml.append('<entry id="{0}" name="hsa:{0}" type="gene"><graphics name="GENE{0}" '
+                   'x="{1}" y="{2}" width="46" height="17"/></entry>'.format(i + 1, rng.integers(0, 1200), rng.integers(0, 900)))
+    xml.append('<entry id="{}" name="path:{}" type="map"><graphics name="TITLE:{}" '
+               'x="100" y="50" width="120" height="25"/></entry>'.format(nodes + 1, pathway, pathway))
+    xml.append('<entry id="{}" name="undefined" type="group"><graphics x="300" y="300" width="80" height="60"/>'
+               '<component id="1"/><component id="2"/></entry>'.format(nodes + 2))
+    for i in range(nodes * 3 // 2):
+        entry1, entry2 = rng.integers(1, nodes + 1, 2)
+        subtype = rng.choice(['activation', 'inhibition', 'expression', 'indirect effect', 'binding/association'])
+        xml.append('<relation entry1="{}" entry2="{}" type="PPrel"><subtype name="{}" value="-->"/></relation>'
+                   .format(entry1, entry2, subtype))
+    xml.append('</pathway>')
+    return '\n'.join(xml)
+
+
+def gen_fa(out_dir, contrasts, pathways, nodes, seed=0):
+    rng = np.random.default_rng(seed)
+    pathway_ids = ['hsa{:05d}'.format(4000 + i) for i in range(pathways)]
+    for c in range(contrasts):
+        contrast_dir = join(out_dir, 'contrast_{}'.format(c))
+        os.makedirs(contrast_dir, exist_ok=True)
+        pd.DataFrame({
+            'ID': pathway_ids,
+            'Description': ['Pathway {}'.format(i) for i in range(pathways)],
+            'setSize': rng.integers(10, 300, pathways),
+            'enrichmentScore': rng.uniform(-1, 1, pathways),
+            'NES': rng.uniform(-3, 3, pathways),
+            'pvalue': rng.random(pathways) * 0.05,
+            'p.adjust': rng.random(pathways) * 0.1,
+        }).to_csv(join(contrast_dir, 'pathway_table.csv'), index=False)
+
+        for k, pathway in enumerate(pathway_ids):
+            # the pathway geometry is the same in every contrast, only the colours change
+            geometry = np.random.default_rng(seed + k)
+            pd.DataFrame({
+                'kegg.names': [str(i) for i in range(nodes)],
+                'labels': ['GENE{}'.format(i) for i in range(nodes)],
+                'type': geometry.choice(['gene', 'compound'], nodes, p=[0.9, 0.1]),
+                'x': geometry.integers(0, 1200, nodes),
+                'y': geometry.integers(0, 900, nodes),
+                'width': 46,
+                'height': 17,
+                'mol.col': rng.choice(['#FF0000', '#00FF00', '#BEBEBE', '#FFFFFF'], nodes),
+            }, index=[str(i + 1) for i in range(nodes)]).to_csv(join(contrast_dir, pathway + '_pathway.csv'))
+            with open(join(contrast_dir, pathway + '.xml'), 'w') as f:
+                f.write(kegg_xml(pathway, nodes, np.random.default_rng(seed + k)))
+
+
+def gen_pca_data(fpath, samples, pcs=3, seed=0):
+    """ rnaseq_az pca_data.txt as written by R: quoted fields, no row name header, variance comment """
+    rng = np.random.default_rng(seed)
+    values = rng.normal(0, 1, (samples, pcs)) * np.linspace(20, 2, pcs)
+    conds = conditions(samples, rng)
+    names = sample_names(samples)
+    lines = [' '.join('"{}"'.format(c) for c in ['PC{}'.format(i + 1) for i in range(pcs)] + ['group', 'condition', 'name'])]
+    lines.append('#variance: ' + ','.join('{:.1f}'.format(v) for v in np.linspace(40, 5, pcs)))
+    for name, row, cond in zip(names, values, conds):
+        lines.append(' '.join(['"{}"'.format(name)] + [repr(float(v)) for v in row] +
+                              ['"{}"'.format(cond), '"{}"'.format(cond), '"{}"'.format(name)]))
+    opener = gzip.open if fpath.endswith('.gz') else open
+    with opener(fpath, 'wt') as f:
+        f.write('\n'.join(lines) + '\n')
+    return pd.DataFrame(values, index=names, columns=['pc{}'.format(i + 1) for i in range(pcs)]).assign(condition=conds)
+
+
+def gen_sample_maps(out_dir, samples, seed=0):
+    """ az.ngs_report_by_sample_file and az.gender_by_sample_file sidecars for a large cohort """
+    rng = np.random.default_rng(seed)
+    names = sample_names(samples)
+    with open(join(out_dir, 'ngs_report_by_sample.tsv'), 'w') as f:
+        for i, name in enumerate(names):
+            # some samples without a report
+            url = '' if i % 50 == 0 else 'https://ngs.example.org/reports/{}/report.html'.format(name)
+            f.write(name + '\t' + url + '\n')
+    with open(join(out_dir, 'gender_by_sample.json'), 'w') as f:
+        json.dump(dict(zip(names, rng.choice(['M', 'F'], samples).tolist())), f)
+
+
+def generate(out_dir, genes, samples, contrasts, pathways, nodes, pca_samples, cohort_samples, seed=0):
+    gen_qc(join(out_dir, 'qc'), genes, samples, seed)
+    gen_de(join(out_dir, 'de'), genes, contrasts, seed)
+    gen_fa(join(out_dir, 'fa'), contrasts, pathways, nodes, seed)
+    os.makedirs(join(out_dir, 'az'), exist_ok=True)
+    gen_pca_data(join(out_dir, 'az', 'pca_data.txt.gz'), pca_samples, seed=seed)
+    gen_sample_maps(join(out_dir, 'az'), cohort_samples, seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('out_dir')
+    parser.add_argument('--genes', type=int, default=5000)
+    parser.add_argument('--samples', type=int, default=12)
+    parser.add_argument('--contrasts', type=int, default=3)
+    parser.add_argument('--pathways', type=int, default=5)
+    parser.add_argument('--nodes', type=int, default=40)
+    parser.add_argument('--pca-samples', type=int, default=1000)
+    parser.add_argument('--cohort-samples', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.out_dir, args.genes, args.samples, args.contrasts, args.pathways, args.nodes,
+             args.pca_samples, args.cohort_samples, args.seed)
+
+
+if __name__ == '__main__':
+    main()
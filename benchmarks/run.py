@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+""" Benchmarks of the RNA-seq modules on synthetic bcbio outputs.
+
+    python benchmarks/run.py [--scale small|medium|large|pathways] [--bench NAME ...]
+                             [--repeat N] [--save-baseline] [--tolerance 1.5]
+
+Data for the scale point is generated with generate.py into --data-dir (reused while its
+parameters match). Every benchmark runs in its own Python process against the stubbed
+MultiQC in benchmarks/stubs, and records wall and CPU time, peak RSS and output size.
+Results are compared with baselines/<scale>.json: a benchmark fails when its wall time
+or peak RSS exceeds the baseline times --tolerance, when its output size changes, or when
+its correctness check fails. --save-baseline writes the current results as the baseline.
+The pathways scale point is small apart from the functional analysis: 200 KEGG pathways
+in each of 10 contrasts, for bcbio_rnaseq_fa and fa_nodes. """
+
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from os.path import join, dirname, abspath, isfile
+from collections import OrderedDict
+
+bench_dir = dirname(abspath(__file__))
+repo_dir = dirname(bench_dir)
+
+scales = OrderedDict([
+    ('small', dict(genes=5000, samples=12, contrasts=3, pathways=5, nodes=40, pca_samples=10000, cohort_samples=1000)),
+    ('medium', dict(genes=20000, samples=100, contrasts=6, pathways=20, nodes=80, pca_samples=10000, cohort_samples=10000)),
+    ('large', dict(genes=60000, samples=500, contrasts=10, pathways=50, nodes=120, pca_samples=10000, cohort_samples=50000)),
+    ('pathways', dict(genes=5000, samples=12, contrasts=10, pathways=200, nodes=60, pca_samples=10000, cohort_samples=1000)),
+])
+
+
+# Benchmarks, run inside the worker process. Each returns (output bytes, check) where
+# check is None or an error message.
+
+def configure(analysis_dir):
+    import yaml
+    from multiqc.utils import config
+    with open(join(repo_dir, 'multiqc_az', 'multiqc_config.yaml')) as f:
+        config.sp = yaml.safe_load(f)['sp']
+    config.analysis_dir = [analysis_dir]
+    config.output_dir = tempfile.mkdtemp(prefix='multiqc_az_bench_')
+    config.az = {}
+
+
+def section_bytes(module):
+    return sum(len(str(s.get(k) or '')) for s in module.sections for k in ['description', 'plot', 'content'])
+
+
+def run_module(module_name, subdir):
+    def bench(data_dir):
+        import importlib
+        configure(join(data_dir, subdir))
+        module = importlib.import_module('multiqc_az.modules.' + module_name).MultiqcModule()
+        return section_bytes(module), None
+    return bench
+
+
+def bench_qc_biotype(data_dir):
+    """ Biotype annotation join and per-(biotype, sample) box statistics of tpm_perbiotype """
+    configure(join(data_dir, 'qc'))
+    import pandas as pd
+    from multiqc_az.modules.bcbio_rnaseq_qc import MultiqcModule
+    tpm = pd.read_csv(join(data_dir, 'qc', 'tpm.csv'), index_col=0)
+    biotype = pd.read_csv(join(data_dir, 'qc', 'gene2biotype.csv'), index_col=0)
+    module = MultiqcModule.__new__(MultiqcModule)
+    module.sections = []
+    module.tpm_perbiotype(tpm, biotype)
+    return section_bytes(module), None
+
+
+def bench_fa_nodes(data_dir):
+    """ Cytoscape node tables of all <pathway>_pathway.csv files """
+    from multiqc_az.modules.bcbio_rnaseq_fa.bcbio_rnaseq_fa import read_pathway_nodes
+    nodes = [read_pathway_nodes(fpath) for fpath in sorted(glob.glob(join(data_dir, 'fa', '*', '*_pathway.csv')))]
+    return len(json.dumps(nodes)), None
+
+
+def bench_az_pca_parse(data_dir):
+    """ rnaseq_az PCA parser, checked against the values the file was generated from """
+    import numpy as np
+    from generate import gen_pca_data
+    from multiqc_az.modules.rnaseq_az.rnaseq_az import parse_pca_data
+    fpath = join(data_dir, 'az', 'pca_data.txt.gz')
+    pca_data, variances = parse_pca_data(fpath)
+
+    params = json.load(open(join(data_dir, 'params.json')))
+    expected = gen_pca_data(join(tempfile.mkdtemp(), 'pca_data.txt'), params['pca_samples'])
+    if list(pca_data.index) != list(expected.index):
+        return 0, 'sample names differ'
+    if list(pca_data['condition']) != list(expected['condition']):
+        return 0, 'conditions differ'
+    pcs = [c for c in expected.columns if c.startswith('pc')]
+    if list(pca_data.columns[:len(pcs)]) != pcs or not np.allclose(pca_data[pcs].values, expected[pcs].values):
+        return 0, 'PC values differ'
+    if len(variances) != len(pcs):
+        return 0, 'expected {} variances, got {}'.format(len(pcs), len(variances))
+    return len(pca_data.to_csv()), None
+
+
+def bench_config_load(data_dir):
+    """ config_loaded and execution_start hooks, with the per-sample maps of a large cohort in sidecar files """
+    configure(join(data_dir, 'az'))
+    from multiqc.utils import config
+    from multiqc_az.multiqc_az import config_loaded, execution_start
+    config.az = {'ngs_report_by_sample_file': join(data_dir, 'az', 'ngs_report_by_sample.tsv'),
+                 'gender_by_sample_file': join(data_dir, 'az', 'gender_by_sample.json')}
+    config_loaded()
+    execution_start()
+
+    samples = json.load(open(join(data_dir, 'params.json')))['cohort_samples']
+    for name in ['ngs_report_by_sample', 'gender_by_sample']:
+        if len(config.az.get(name) or {}) != samples:
+            return 0, 'expected {} samples in {}, got {}'.format(samples, name, len(config.az.get(name) or {}))
+    if config.template != 'az':
+        return 0, 'plugin defaults were not applied'
+    return 0, None
+
+
+plugin_modules = ['multiqc_az.multiqc_az', 'multiqc_az.modules.rnaseq_az', 'multiqc_az.modules.bcbio_rnaseq_qc',
+                  'multiqc_az.modules.bcbio_rnaseq_de', 'multiqc_az.modules.bcbio_rnaseq_fa']
+heavy_modules = ['numpy', 'pandas', 'scipy', 'plotly']
+
+
+def bench_import(data_dir):
+    """ Import of the hooks and module entry points, which MultiQC does on every run, and the modules
+    on a directory without RNA-seq data. Neither should load the heavy dependencies. """
+    import importlib
+    modules = [importlib.import_module(name) for name in plugin_modules]
+    loaded = [name for name in heavy_modules if name in sys.modules]
+    if loaded:
+        return 0, 'plugin import loaded ' + ', '.join(loaded)
+
+    configure(tempfile.mkdtemp(prefix='multiqc_az_bench_empty_'))
+    for module in modules[1:]:
+        try:
+            module.MultiqcModule()
+        except UserWarning:
+            pass
+    loaded = [name for name in heavy_modules if name in sys.modules]
+    if loaded:
+        return 0, 'modules without input files loaded ' + ', '.join(loaded)
+    return 0, None
+
+
+benchmarks = OrderedDict([
+    ('import', bench_import),
+    ('config_load', bench_config_load),
+    ('rnaseq_az', run_module('rnaseq_az', 'az')),
+    ('bcbio_rnaseq_qc', run_module('bcbio_rnaseq_qc', 'qc')),
+    ('bcbio_rnaseq_qc.cached', run_module('bcbio_rnaseq_qc', 'qc')),
+    ('bcbio_rnaseq_de', run_module('bcbio_rnaseq_de', 'de')),
+    ('bcbio_rnaseq_de.cached', run_module('bcbio_rnaseq_de', 'de')),
+    ('bcbio_rnaseq_fa', run_module('bcbio_rnaseq_fa', 'fa')),
+    ('bcbio_rnaseq_fa.cached', run_module('bcbio_rnaseq_fa', 'fa')),
+    ('qc_biotype', bench_qc_biotype),
+    ('fa_nodes', bench_fa_nodes),
+    ('az_pca_parse', bench_az_pca_parse),
+])
+
+
+def peak_rss_mb():
+    import resource
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def worker(name, data_dir):
+    """ Runs one benchmark and prints its result as JSON """
+    start_wall, start_cpu = time.perf_counter(), os.times()
+    output_bytes, check = benchmarks[name](data_dir)
+    end_cpu = os.times()
+    print(json.dumps({
+        'wall_s': round(time.perf_counter() - start_wall, 3),
+        'cpu_s': round(sum(end_cpu[:4]) - sum(start_cpu[:4]), 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'output_bytes': output_bytes,
+        'check': check,
+    }))
+
+
+def prepare_data(data_dir, params):
+    params_fpath = join(data_dir, 'params.json')
+    if isfile(params_fpath) and json.load(open(params_fpath)) == params:
+        return
+    if os.path.isdir(data_dir):
+        shutil.rmtree(data_dir)
+    print('Generating data in {}'.format(data_dir))
+    # in a separate process, so its memory does not count towards the peak RSS of the forked workers
+    subprocess.check_call([sys.executable, join(bench_dir, 'generate.py'), data_dir] +
+                          ['--{}={}'.format(k.replace('_', '-'), v) for k, v in params.items()])
+    with open(params_fpath, 'w') as f:
+        json.dump(params, f)
+
+
+def clear_csv_cache(data_dir):
+    for fpath in glob.glob(join(data_dir, '**', '.*.cache*'), recursive=True):
+        if os.path.isdir(fpath):
+            shutil.rmtree(fpath)
+        else:
+            os.remove(fpath)
+
+
+def run_benchmark(name, data_dir, repeat=1):
+    """ Best of repeat runs, each in a fresh process """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([join(bench_dir, 'stubs'), repo_dir, bench_dir] +
+                                        ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    best = None
+    for _ in range(repeat):
+        if not name.endswith('.cached'):
+            clear_csv_cache(data_dir)
+        proc = subprocess.run([sys.executable, abspath(__file__), '--worker', name, data_dir],
+                              env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            return {'error': proc.stderr.strip().split('\n')[-1]}
+        result = json.loads(proc.stdout.strip().split('\n')[-1])
+        if best is None or result['wall_s'] < best['wall_s']:
+            best = result
+    return best
+
+
+def compare(result, baseline, tolerance):
+    """ List of problems of a result compared with its baseline """
+    if 'error' in result:
+        return [result['error']]
+    problems = []
+    if result['check']:
+        problems.append('check failed: ' + result['check'])
+    if baseline:
+        # differences under 100 ms or 10 MB are noise
+        if result['wall_s'] > baseline['wall_s'] * tolerance and result['wall_s'] - baseline['wall_s'] > 0.1:
+            problems.append('wall time {wall_s}s, baseline {0}s'.format(baseline['wall_s'], **result))
+        if result['peak_rss_mb'] > baseline['peak_rss_mb'] * tolerance and result['peak_rss_mb'] - baseline['peak_rss_mb'] > 10:
+            problems.append('peak RSS {peak_rss_mb}MB, baseline {0}MB'.format(baseline['peak_rss_mb'], **result))
+        if abs(result['output_bytes'] - baseline['output_bytes']) > 0.01 * baseline['output_bytes']:
+            problems.append('output {output_bytes} bytes, baseline {0} bytes'.format(baseline['output_bytes'], **result))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=list(scales), default='small')
+    parser.add_argument('--bench', nargs='*', choices=list(benchmarks), help='Benchmarks to run, all by default')
+    parser.add_argument('--data-dir', help='Where to generate the data, in the temp dir by default')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--repeat', type=int, default=1, help='Keep the best of this many runs of each benchmark')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--worker', nargs=2, metavar=('NAME', 'DATA_DIR'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(*args.worker)
+        return
+
+    data_dir = args.data_dir or join(tempfile.gettempdir(), 'multiqc_az_bench', args.scale)
+    prepare_data(data_dir, scales[args.scale])
+
+    baseline_fpath = join(bench_dir, 'baselines', args.scale + '.json')
+    baselines = json.load(open(baseline_fpath)) if isfile(baseline_fpath) else {}
+
+    results = OrderedDict()
+    failed = False
+    print('{:<24} {:>8} {:>8} {:>9} {:>12}  {}'.format('benchmark', 'wall, s', 'cpu, s', 'RSS, MB', 'output, B', 'status'))
+    for name in args.bench or list(benchmarks):
+        result = results[name] = run_benchmark(name, data_dir, args.repeat)
+        problems = compare(result, None if args.save_baseline else baselines.get(name), args.tolerance)
+        failed = failed or bool(problems)
+        if 'error' in result:
+            print('{:<24} {}'.format(name, 'ERROR: ' + result['error']))
+        else:
+            print('{0:<24} {wall_s:>8} {cpu_s:>8} {peak_rss_mb:>9} {output_bytes:>12}  {1}'.format(
+                name, '; '.join(problems) or 'ok', **result))
+
+    if args.save_baseline:
+        baselines.update((name, result) for name, result in results.items() if 'error' not in result)
+        with open(baseline_fpath, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(baseline_fpath))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+""" Minimal stand-in for the parts of MultiQC used by the plugin, so the modules
+can be benchmarked headlessly without a full MultiQC installation and run. """
+
+from multiqc.utils import config
@@ -0,0 +1,37 @@
+import os
+import fnmatch
+from os.path import join
+
+from multiqc.utils import config
+
+
+class BaseMultiqcModule(object):
+    """ Finds files with the fn pattern(s) of config.sp under config.analysis_dir,
+    and keeps sections in a list """
+    def __init__(self, name=None, anchor=None, **kwargs):
+        self.name = name
+        self.anchor = anchor
+        self.sections = []
+
+    def find_log_files(self, sp_key, filecontents=True):
+        sp = config.sp.get(sp_key, {})
+        patterns = [p['fn'] for p in (sp if isinstance(sp, list) else [sp]) if p.get('fn')]
+        if not patterns:
+            return
+        for analysis_dir in config.analysis_dir:
+            for root, dirs, files in os.walk(analysis_dir):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                for fn in sorted(files):
+                    if any(fnmatch.fnmatch(fn, pattern) for pattern in patterns):
+                        f = {'root': root, 'fn': fn, 's_name': fn}
+                        if filecontents:
+                            with open(join(root, fn)) as fh:
+                                f['f'] = fh.read()
+                        yield f
+
+    def add_section(self, name=None, anchor=None, description='', helptext='', plot='', content='', **kwargs):
+        self.sections.append({'name': name, 'anchor': anchor, 'description': description,
+                              'helptext': helptext, 'plot': plot, 'content': content})
+
+    def ignore_samples(self, data):
+        return data
@@ -0,0 +1,6 @@
+import json
+
+
+def plot(*args, **kwargs):
+    """ The plot data as JSON, so the size of the section reflects what MultiQC would embed """
+    return '<div>' + json.dumps(args, default=str) + '</div>'
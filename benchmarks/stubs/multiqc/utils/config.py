@@ -0,0 +1,13 @@
+analysis_dir = ['.']
+output_dir = None
+max_table_rows = 500
+sp = {}
+
+
+def update_dict(target, source):
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            update_dict(target[key], value)
+        else:
+            target[key] = value
+    return target
@@ -0,0 +1,3 @@
+general_stats_data = []
+general_stats_headers = []
+general_stats_html = ''
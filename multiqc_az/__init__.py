@@ -1,6 +1,21 @@
-from pkg_resources import get_distribution
+from os.path import join, dirname, isfile
+
+try:
+    from importlib.metadata import version, PackageNotFoundError
+except ImportError:  # Python < 3.8
+    from importlib_metadata import version, PackageNotFoundError
+
 from multiqc.utils import config
 
-__version__ = get_distribution("multiqc_az").version
-config.multiqc_az_version = __version__
 
+def _get_version():
+    try:
+        return version('multiqc_az')
+    except PackageNotFoundError:
+        # running from a source checkout
+        version_fpath = join(dirname(dirname(__file__)), 'VERSION.txt')
+        return open(version_fpath).read().strip().split('\n')[0] if isfile(version_fpath) else 'unknown'
+
+
+__version__ = _get_version()
+config.multiqc_az_version = __version__
@@ -0,0 +1,180 @@
+""" Columnar binary sidecar cache for the large CSV inputs of the RNA-seq modules.
+
+Each cached table is a pair of hidden files next to the input file, or under
+az.csv_cache_dir when set: a .npy with the numeric columns as one 2-D matrix
+(float32, or their common dtype), memory mapped on load, and a .npz with the
+string columns as categorical codes, the index, any numeric columns of another
+dtype, and the source path, mtime and size. The cache is rebuilt whenever any of
+those change, and caches of the same input written with other read options
+are removed then. """
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import logging
+from collections import Counter
+from os.path import join, dirname, basename, abspath, expanduser, isdir
+
+from multiqc_az.utils import get_az_config, lazy_import
+from multiqc_az.profiling import count_input
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+log = logging.getLogger('multiqc.multiqc_az')
+
+CACHE_VERSION = 2
+
+
+def _digest(value):
+    return hashlib.md5(value.encode('utf-8')).hexdigest()[:8]
+
+
+def _cache_stem(fpath):
+    """ Directory and file name prefix shared by all caches of fpath """
+    root = get_az_config('csv_cache_dir')
+    if root:
+        return expanduser(root), '.' + basename(fpath) + '.' + _digest(abspath(fpath))
+    return dirname(abspath(fpath)), '.' + basename(fpath)
+
+
+def _cache_base(fpath, float32, read_kwargs):
+    cache_dir, stem = _cache_stem(fpath)
+    key = json.dumps([float32, read_kwargs], sort_keys=True, default=str)
+    return join(cache_dir, stem + '.' + _digest(key) + '.cache')
+
+
+def _remove_stale(fpath, cache_base):
+    """ Removes the caches of fpath other than cache_base, and leftovers of interrupted writes """
+    cache_dir, stem = _cache_stem(fpath)
+    stale_re = re.compile(re.escape(stem + '.') + r'[0-9a-f]{8}\.cache(\..*)?$')
+    keep = {basename(cache_base) + '.npy', basename(cache_base) + '.npz'}
+    for fn in os.listdir(cache_dir):
+        if stale_re.match(fn) and fn not in keep:
+            path = join(cache_dir, fn)
+            if isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def _source_key(fpath):
+    st = os.stat(fpath)
+    return {'path': abspath(fpath), 'mtime': st.st_mtime_ns, 'size': st.st_size}
+
+
+def _save_categorical(arrays, name, values):
+    cat = pd.Categorical(values)
+    arrays[name] = cat.codes
+    return {'kind': 'categorical', 'categories': cat.categories.tolist()}
+
+
+def _load_categorical(arrays, name, meta):
+    return pd.Categorical.from_codes(arrays[name], meta['categories'])
+
+
+def _write_cache(df, cache_base, source_key, float32):
+    columns = []
+    for name, col in df.items():
+        values = col.values
+        if isinstance(values, pd.Categorical) or values.dtype == object or values.dtype.kind not in 'iufb':
+            if values.dtype.kind in 'mM':
+                raise TypeError('Unsupported column dtype for caching: {}'.format(values.dtype))
+            columns.append((name, 'categorical', values))
+        else:
+            if values.dtype.kind in 'iuf' and float32:
+                values = values.astype(np.float32)
+            columns.append((name, 'numeric', values))
+
+    # the numeric columns of the most common dtype form the memory mapped matrix
+    dtypes = Counter(values.dtype for _, kind, values in columns if kind == 'numeric')
+    matrix_dtype = dtypes.most_common(1)[0][0] if dtypes else None
+
+    arrays = dict()
+    meta = {'version': CACHE_VERSION, 'source': source_key, 'columns': [], 'index': None}
+    if not isinstance(df.index, pd.RangeIndex):
+        meta['index'] = _save_categorical(arrays, 'index', np.asarray(df.index, dtype=object))
+        meta['index']['name'] = df.index.name
+    matrix_columns = []
+    for i, (name, kind, values) in enumerate(columns):
+        if kind == 'categorical':
+            col_meta = _save_categorical(arrays, 'col' + str(i), values)
+        elif values.dtype == matrix_dtype:
+            col_meta = {'kind': 'matrix', 'column': len(matrix_columns)}
+            matrix_columns.append(values)
+        else:
+            arrays['col' + str(i)] = values
+            col_meta = {'kind': 'numeric'}
+        col_meta['name'] = name
+        meta['columns'].append(col_meta)
+    arrays['meta'] = np.array(json.dumps(meta))
+
+    if not isdir(dirname(cache_base)):
+        os.makedirs(dirname(cache_base))
+    tmp = cache_base + '.tmp' + str(os.getpid())
+    matrix = np.column_stack(matrix_columns) if matrix_columns else np.empty((len(df), 0))
+    np.save(tmp + '.npy', np.ascontiguousarray(matrix))
+    with open(tmp + '.npz', 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(tmp + '.npy', cache_base + '.npy')
+    os.rename(tmp + '.npz', cache_base + '.npz')
+    _remove_stale(source_key['path'], cache_base)
+
+
+def _read_cache(cache_base, source_key):
+    try:
+        arrays = np.load(cache_base + '.npz', allow_pickle=False)
+    except (IOError, OSError):
+        return None
+    with arrays:
+        meta = json.loads(str(arrays['meta']))
+        if meta.get('version') != CACHE_VERSION or meta.get('source') != source_key:
+            return None
+        # copy-on-write mapping: pages are read from disk on demand, and writes stay in memory
+        matrix = np.load(cache_base + '.npy', mmap_mode='c')
+
+        index = None
+        if meta['index'] is not None:
+            index = pd.Index(np.asarray(_load_categorical(arrays, 'index', meta['index'])), name=meta['index']['name'])
+        df = pd.DataFrame(matrix, index=index, copy=False,
+                          columns=[c['name'] for c in meta['columns'] if c['kind'] == 'matrix'])
+        # the other columns are inserted in place, leaving the matrix block as it is
+        for i, c in enumerate(meta['columns']):
+            if c['kind'] == 'categorical':
+                df.insert(i, c['name'], _load_categorical(arrays, 'col' + str(i), c))
+            elif c['kind'] == 'numeric':
+                df.insert(i, c['name'], arrays['col' + str(i)])
+    return df
+
+
+def read_csv_cached(fpath, float32=False, **read_kwargs):
+    """ pd.read_csv(fpath, **read_kwargs) through the sidecar cache.
+    With float32=True numeric columns are stored and returned as float32. """
+    count_input(fpath)
+    if not get_az_config('csv_cache', True):
+        return pd.read_csv(fpath, **read_kwargs)
+
+    cache_base = _cache_base(fpath, float32, read_kwargs)
+    source_key = _source_key(fpath)
+    try:
+        df = _read_cache(cache_base, source_key)
+        if df is not None:
+            log.debug('Loaded {} from cache {}'.format(fpath, cache_base))
+            return df
+    except (IOError, OSError, ValueError, KeyError) as e:
+        log.debug('Could not read cache {}: {}'.format(cache_base, e))
+
+    df = pd.read_csv(fpath, **read_kwargs)
+    for name, col in df.items():
+        if col.dtype.kind in 'iuf':
+            if float32:
+                df[name] = col.astype(np.float32)
+        elif col.dtype.kind != 'b':
+            df[name] = col.astype('category')
+    try:
+        _write_cache(df, cache_base, source_key, float32)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        log.debug('Could not write cache {}: {}'.format(cache_base, e))
+    return df
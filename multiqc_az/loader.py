@@ -0,0 +1,36 @@
+""" Loading of the CSV inputs of the RNA-seq modules. On network filesystems
+per-file latency dominates, so the files are read on a thread pool of
+az.loader_workers threads (1 to read serially). Gene-level tables too large
+for memory can be read in chunks instead. """
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from multiqc_az.cache import read_csv_cached
+from multiqc_az.utils import get_az_config, lazy_import
+from multiqc_az.profiling import count_input
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+def load_tables(files, workers=None):
+    """ Reads {key: (fpath, read_kwargs)} and returns {key: DataFrame} in the same order.
+    read_kwargs are passed to read_csv_cached. """
+    keys = list(files)
+    workers = int(workers or get_az_config('loader_workers', 8))
+    if workers <= 1 or len(keys) <= 1:
+        return OrderedDict((k, read_csv_cached(files[k][0], **files[k][1])) for k in keys)
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(keys))) as pool:
+        futures = [pool.submit(read_csv_cached, files[k][0], **files[k][1]) for k in keys]
+        return OrderedDict((k, future.result()) for k, future in zip(keys, futures))
+
+
+def iter_gene_table_chunks(fpath, chunksize):
+    """ Reads a gene-level table (gene IDs in the first column, one value column per sample)
+    in chunks of chunksize rows, with the gene IDs as index and the values as float32. """
+    count_input(fpath)
+    header = pd.read_csv(fpath, nrows=0)
+    dtype = OrderedDict((c, np.float32) for c in header.columns[1:])
+    return pd.read_csv(fpath, index_col=0, dtype=dtype, chunksize=int(chunksize))
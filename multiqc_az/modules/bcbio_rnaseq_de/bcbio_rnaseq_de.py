@@ -2,82 +2,197 @@
 
 """ MultiQC module to add link to Bcl2fastq reports """
 
-import plotly as py
-import plotly.graph_objs as go
+import json
+import gzip
+import base64
 from os.path import join, dirname, abspath
-import pandas as pd
-import numpy as np
 from collections import OrderedDict
 
 from multiqc.plots import table, scatter, heatmap
 from multiqc.modules.base_module import BaseMultiqcModule
 from multiqc import config
+from multiqc_az.loader import load_tables
+from multiqc_az.utils import get_az_config, lazy_import
+from multiqc_az.plotly_assets import require_plotlyjs, to_json
+from multiqc_az.profiling import profiled
 import logging
 
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+py = lazy_import('plotly')
+go = lazy_import('plotly.graph_objs')
+
 # Initialise the logger
 log = logging.getLogger(__name__.replace('multiqc_az', 'multiqc'))
 
 
+def de_mask(df):
+    """ Genes passing the DE thresholds """
+    return (df['p'] > 1) & (abs(df['lfc']) > 0.5)
+
+
+def downsample(df, keep, max_points, seed=0):
+    """ Splits df into rows to draw as points and rows to fold into a density layer.
+    All rows where keep is True are drawn, plus at most max_points of the others. """
+    rest = df.loc[~keep]
+    if not max_points or len(rest) <= max_points:
+        return df, rest.iloc[:0]
+    sampled = rest.sample(n=max_points, random_state=seed)
+    shown = pd.concat([df.loc[keep], sampled]).sort_index()
+    return shown, rest.drop(sampled.index)
+
+
+def density_trace(x, y, log_x=False, bins=60):
+    """ Binned counts of the dropped points, drawn as a grey heatmap under the scatter """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    ok = np.isfinite(x) & np.isfinite(y)
+    if log_x:
+        ok &= x > 0
+        x = np.log10(x[ok])
+    else:
+        x = x[ok]
+    y = y[ok]
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins)
+    x_centers = (x_edges[:-1] + x_edges[1:]) / 2
+    if log_x:
+        x_centers = 10 ** x_centers
+    z = np.where(counts > 0, counts, np.nan).T
+    return go.Heatmap(x=x_centers.tolist(),
+                      y=((y_edges[:-1] + y_edges[1:]) / 2).tolist(),
+                      z=[[None if np.isnan(v) else int(v) for v in row] for row in z],
+                      colorscale=[[0, '#eeeeee'], [1, '#555555']],
+                      showscale=False,
+                      hoverinfo='z',
+                      name='density of downsampled genes')
+
+
+def de_membership(de):
+    """ Boolean genes x contrasts matrix of DE gene membership over the union of DE genes """
+    gene_sets = OrderedDict()
+    for c in de:
+        id_col = 'gene_id' if 'gene_id' in de[c] else 'gene'
+        gene_sets[c] = pd.Index(de[c].loc[de_mask(de[c]), id_col].astype(str).unique())
+
+    genes = pd.Index(sorted(set().union(*gene_sets.values())))
+    membership = np.zeros((len(genes), len(gene_sets)), dtype=bool)
+    for j, ids in enumerate(gene_sets.values()):
+        membership[genes.get_indexer(ids), j] = True
+    return pd.DataFrame(membership, index=genes, columns=list(gene_sets))
+
+
+def de_intersections(membership, top=20):
+    """ Upset-style counts: genes DE in exactly each combination of contrasts, largest first """
+    m = membership.values
+    if not len(m):
+        return OrderedDict()
+    packed = np.ascontiguousarray(np.packbits(m, axis=1))
+    rows = packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+    _, first, counts = np.unique(rows, return_index=True, return_counts=True)
+
+    intersections = OrderedDict()
+    for i in np.argsort(-counts, kind='stable')[:top]:
+        in_set = m[first[i]]
+        label = ' & '.join(membership.columns[in_set])
+        intersections[label] = {'contrasts': int(in_set.sum()), 'genes': int(counts[i])}
+    return intersections
+
+
+top_gene_scores = {
+    'p': lambda df: df['p'],
+    'padj': lambda df: df['padj'],
+    'lfc': lambda df: df['lfc'].abs(),
+}
+
+
+def top_genes(df, n=20, by='p'):
+    """ The n highest ranked genes by p, padj or |lfc|, selected without sorting or modifying df """
+    return df.loc[top_gene_scores[by](df).nlargest(n).index]
+
+
+def plot_settings():
+    scatter_cls = go.Scattergl if get_az_config('de_plot_webgl', True) else go.Scatter
+    return scatter_cls, get_az_config('de_plot_max_points', 5000)
+
+
+def encode_traces(traces):
+    """ gzip + base64 JSON of a contrast's traces, decoded in the browser on demand """
+    js = json.dumps(traces, cls=py.utils.PlotlyJSONEncoder)
+    return base64.b64encode(gzip.compress(js.encode('utf-8'))).decode('ascii')
+
+
+def lazy_contrast_plot(div_id, layout, contrasts):
+    """ One plot with a button per contrast. contrasts is a list of (label, title, traces);
+    only the first contrast is decoded on page load, the others when their button is clicked. """
+    spec = {
+        'layout': layout.to_plotly_json(),
+        'contrasts': [{'title': title, 'data': encode_traces(traces)} for _, title, traces in contrasts],
+    }
+    spec_json = to_json(spec)
+    require_plotlyjs()
+
+    with open(join(dirname(abspath(__file__)), 'lazy_plot.txt')) as f:
+        script = f.read()
+
+    buttons = ''.join('<button type="button" class="btn btn-default btn-sm" data-contrast="{}">{}</button>'.format(i, label)
+                      for i, (label, _, _) in enumerate(contrasts))
+    return script + \
+        '<div id="' + div_id + '-buttons" class="btn-group" role="group">' + buttons + '</div>' + \
+        '<div id="' + div_id + '" style="height: ' + str(layout['height']) + 'px;"></div>' + \
+        '<script type="application/json" id="' + div_id + '-data">' + spec_json + '</script>' + \
+        '<script> $(function(){ mqcAzPlotly(function(){ mqcAzLazyPlot("' + div_id + '"); }); }); </script>'
+
+
+def dropped_note(dropped, total):
+    return '{:,} of {:,} genes outside the DE thresholds were binned into a density layer'.format(dropped, total)
+
+
+@profiled()
 class MultiqcModule(BaseMultiqcModule):
 
     def addVolcano(self, de):
 
-        data = []
-        buttons = []
-        i=0
-        first_title=''
+        scatter_cls, max_points = plot_settings()
+        contrasts = []
+        total_dropped = 0
+        total_genes = 0
         for c in de:
-            vis=False
-            if i==0:
-                first_title = c
-                vis = True
-
-            low_p = de[c].loc[de[c]['p']<=0.1]
-            hi_p = de[c].loc[de[c]['p'] > 0.1]
-
-            data.append(go.Scatter(x=low_p['lfc'].tolist(),
-                                   y=low_p['p'].tolist(),
-                                   mode = 'markers',
-                                   text=de[c]['gene'].tolist(),
-                                   name='p value < 0.1',
-                                   marker={'color':'#33CFA5'},
-                                   visible=vis))
-
-            data.append(go.Scatter(x=hi_p['lfc'].tolist(),
-                                   y=hi_p['p'].tolist(),
-                                   mode = 'markers',
-                                   text=de[c]['gene'].tolist(),
-                                   name='p value > 0.1',
-                                   marker={'color': '#F06A6A'},
-                                   visible=vis))
-
-            vis_list = [False] * 2 * len(de)
-            vis_list[i * 2]=True
-            vis_list[i * 2 + 1] = True
-
-            i+=1
-
-            buttons.append({'label':c, 'method':'update', 'args':[{'visible':vis_list},{'title':c}]})
-
-        updatemenus = [{'type':"buttons",
-                        'active':-1,
-                        'buttons':buttons}]
-
-
+            shown, dropped = downsample(de[c], de_mask(de[c]), max_points)
+
+            low_p = shown.loc[shown['p'] <= 0.1]
+            hi_p = shown.loc[shown['p'] > 0.1]
+
+            traces = [scatter_cls(x=low_p['lfc'].tolist(),
+                                  y=low_p['p'].tolist(),
+                                  mode='markers',
+                                  text=low_p['gene'].tolist(),
+                                  name='p value < 0.1',
+                                  marker={'color': '#33CFA5'}),
+                      scatter_cls(x=hi_p['lfc'].tolist(),
+                                  y=hi_p['p'].tolist(),
+                                  mode='markers',
+                                  text=hi_p['gene'].tolist(),
+                                  name='p value > 0.1',
+                                  marker={'color': '#F06A6A'})]
+            title = c
+            if len(dropped):
+                density = density_trace(dropped['lfc'], dropped['p'])
+                traces.insert(0, density)
+                title += '<br><sub>' + dropped_note(len(dropped), len(de[c])) + '</sub>'
+
+            contrasts.append((c, title, traces))
+            total_dropped += len(dropped)
+            total_genes += len(de[c])
 
         layout = go.Layout(xaxis=dict(title='Log2 fold change'),
                            yaxis=dict(title='p value'),
-                           height=700,
-                           updatemenus=updatemenus,
-                           title=first_title)
-        fig = go.Figure(data=data, layout=layout)
-
-        tab_content = py.offline.plot(fig, auto_open=False, output_type='div', include_plotlyjs=False)
+                           height=700)
 
         self.add_section(
             name='Volcano',
             anchor='Volcano',
-            content=tab_content
+            description=dropped_note(total_dropped, total_genes) + ' across all contrasts.' if total_dropped else '',
+            content=lazy_contrast_plot('bcbio_rnaseq_de-volcano', layout, contrasts)
         )
 
     def addNumDE_perContrast(self, de):
@@ -107,29 +222,35 @@ class MultiqcModule(BaseMultiqcModule):
 
     def addDE_overlap(self, de):
 
-        de_overlap = {}
-
-        for i in de:
-            de_overlap[i] = {}
-            for j in de:
-                de_i = de[i].loc[(de[i]['p'] > 1) & (abs(de[i]['lfc']) > 0.5)]
-                de_j = de[j].loc[(de[j]['p'] > 1) & (abs(de[j]['lfc']) > 0.5)]
-                i_de_genes = set(de_i.index.tolist())
-                j_de_genes = set(de_j.index.tolist())
-
-                de_overlap[i][j] = len(i_de_genes & j_de_genes)
-
-        de_overlap = pd.DataFrame(de_overlap)
-
-        hmdata = de_overlap.values.tolist()
-        names = de_overlap.index.tolist()
-
-        hm_html = heatmap.plot(hmdata, names)
+        membership = de_membership(de)
+        m = membership.values.astype(np.int64)
+        overlap = m.T.dot(m)
+
+        names = membership.columns.tolist()
+        html = heatmap.plot(overlap.tolist(), names)
+
+        if get_az_config('de_overlap_jaccard', False):
+            sizes = np.diag(overlap)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                jaccard = overlap / (sizes[:, None] + sizes[None, :] - overlap)
+            jaccard = np.nan_to_num(jaccard)
+            html += heatmap.plot(jaccard.tolist(), names, pconfig={
+                'id': 'bcbio_rnaseq_de-overlap-jaccard',
+                'title': 'DE overlap: Jaccard index',
+                'decimalPlaces': 2,
+            })
+
+        if get_az_config('de_overlap_upset', False):
+            intersections = de_intersections(membership, get_az_config('de_overlap_upset_top', 20))
+            headers = OrderedDict()
+            headers['contrasts'] = {'title': 'Contrasts', 'description': 'Number of contrasts in the intersection', 'format': '{:,.0f}'}
+            headers['genes'] = {'title': 'Genes', 'description': 'DE genes in exactly these contrasts', 'format': '{:,.0f}'}
+            html += table.plot(intersections, headers, {'id': 'bcbio_rnaseq_de-overlap-upset', 'col1_header': 'Intersection'})
 
         self.add_section(
             name='DE overlap',
             anchor='DE overlap',
-            content=hm_html,
+            content=html,
             description='Table of numbers of overlapping genes across contrasts'
         )
 
@@ -138,19 +259,19 @@ class MultiqcModule(BaseMultiqcModule):
         tab_header = '<ul>'
         tab_content = '<div>'
 
-        for c in de:
-            print(de[c].head())
-            print(list(de[c]))
-            de[c] = de[c].drop('gene_id', axis=1)
+        n = get_az_config('de_top_genes', 20)
+        by = get_az_config('de_top_genes_by', 'p')
+        if by not in top_gene_scores:
+            log.warning('Unknown az.de_top_genes_by value {}, ranking by p'.format(by))
+            by = 'p'
+        columns = ['gene', 'p', 'padj', 'lfc', 'baseMean'] if by == 'padj' else ['gene', 'p', 'lfc', 'baseMean']
 
-            de[c].sort_values(by='p', inplace=True, ascending=False)
-            top = de[c][0:20]
-            # top = top.set_index('gene')
+        for c in de:
+            top = top_genes(de[c], n, by)
 
             tab_header += '<li>' + c + '</li>'
 
-
-            tab_content += '<div>' + top.to_html(columns=['gene', 'p', 'lfc', 'baseMean'],classes = 'de_top', index=False) + '</div>'
+            tab_content += '<div>' + top.to_html(columns=columns, classes='de_top', index=False) + '</div>'
 
         tab_header += '</ul>'
         tab_content += '</div>'
@@ -171,70 +292,55 @@ class MultiqcModule(BaseMultiqcModule):
 
     def addBaseMeanPlot(self, de):
 
-        data = []
-        buttons = []
-        i=0
-        first_title=''
+        scatter_cls, max_points = plot_settings()
+        contrasts = []
+        total_dropped = 0
+        total_genes = 0
         for c in de:
-            vis=False
-            if i==0:
-                first_title = c
-                vis = True
-
-            data.append(go.Scatter(x=de[c]['baseMean'].tolist(),
-                                   y=de[c]['lfc'].tolist(),
-                                   mode = 'markers',
-                                   text=de[c]['gene'].tolist(),
-                                   name='shrunken',
-                                   marker={'color':'#33CFA5'},
-                                   visible=vis))
-
-            data.append(go.Scatter(x=de[c]['baseMean'].tolist(),
-                                   y=de[c]['lfc_un'].tolist(),
-                                   mode = 'markers',
-                                   text=de[c]['gene'].tolist(),
-                                   name='unshrunken',
-                                   marker={'color': '#F06A6A'},
-                                   visible=vis))
-
-            vis_list = [False] * 2 * len(de)
-            vis_list[i * 2]=True
-            vis_list[i * 2 + 1] = True
-
-            i+=1
-
-            buttons.append({'label':c, 'method':'update', 'args':[{'visible':vis_list},{'title':c}]})
-
-        updatemenus = [{'type':"buttons",
-                        'active':-1,
-                        'buttons':buttons}]
-
-
+            shown, dropped = downsample(de[c], de_mask(de[c]), max_points)
+
+            traces = [scatter_cls(x=shown['baseMean'].tolist(),
+                                  y=shown['lfc'].tolist(),
+                                  mode='markers',
+                                  text=shown['gene'].tolist(),
+                                  name='shrunken',
+                                  marker={'color': '#33CFA5'}),
+                      scatter_cls(x=shown['baseMean'].tolist(),
+                                  y=shown['lfc_un'].tolist(),
+                                  mode='markers',
+                                  text=shown['gene'].tolist(),
+                                  name='unshrunken',
+                                  marker={'color': '#F06A6A'})]
+            title = c
+            if len(dropped):
+                density = density_trace(dropped['baseMean'], dropped['lfc'], log_x=True)
+                traces.insert(0, density)
+                title += '<br><sub>' + dropped_note(len(dropped), len(de[c])) + '</sub>'
+
+            contrasts.append((c, title, traces))
+            total_dropped += len(dropped)
+            total_genes += len(de[c])
 
         layout = go.Layout(xaxis=dict(type='log', autorange=True, title='Mean counts'),
                            yaxis=dict(title='Log2 Fold change'),
-                           height=700,
-                           updatemenus=updatemenus,
-                           title=first_title)
-        fig = go.Figure(data=data, layout=layout)
-
-        tab_content = py.offline.plot(fig, auto_open=False, output_type='div', include_plotlyjs=False)
+                           height=700)
 
         self.add_section(
             name='MA plot',
             anchor='MA plot',
-            content=tab_content
+            description=dropped_note(total_dropped, total_genes) + ' across all contrasts.' if total_dropped else '',
+            content=lazy_contrast_plot('bcbio_rnaseq_de-ma', layout, contrasts)
         )
 
     def __init__(self):
         mod_name = 'bcbio_rnaseq_de'
         super(MultiqcModule, self).__init__(name='RNA Differential Expression', anchor=mod_name)
         # make dict of de-tables per contrast
-        de = {}
+        files = OrderedDict()
         for f in self.find_log_files('bcbio_rnaseq_de/de_gene_key', filecontents=False):
             contrast = f['root'].split('/')
-            data = pd.read_csv(join(f['root'], f['fn']))
-            de[contrast[-1]] = data
+            files[contrast[-1]] = (join(f['root'], f['fn']), {})
+        de = load_tables(files)
 
         if not de:
             log.debug("Could not find files for bcbioRNAseq-DE in {}".format(config.analysis_dir))
@@ -1,16 +1,175 @@
+import os
+import json
 import xml.etree.ElementTree as ET
-import pandas as pd
-from os.path import join, dirname, isfile
+from os.path import join, dirname, abspath, isfile
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from multiqc.modules.base_module import BaseMultiqcModule
 from multiqc.plots import table, heatmap
 from multiqc import config
+from multiqc_az.loader import load_tables
+from multiqc_az.utils import get_az_config, lazy_import
+from multiqc_az.profiling import profiled, count_input, input_counter, add_input_bytes
 import logging
 
+pd = lazy_import('pandas')
+
 # Initialise the logger
 log = logging.getLogger(__name__.replace('multiqc_az', 'multiqc'))
 
+relation_classes = {
+    'inhibition': 'relation inhibition',
+    'indirect effect': 'relation indirect',
+}
+
+# Shared Cytoscape styles, per-node values come from the element data
+graph_style = [
+    {'selector': 'node', 'style': {
+        'content': 'data(label)', 'width': 'data(width)', 'height': 'data(height)',
+        'font-size': 10, 'border-style': 'solid', 'border-color': '#333'}},
+    {'selector': 'node.gene', 'style': {
+        'border-width': 0.5, 'background-color': 'data(color)', 'shape': 'rectangle', 'text-valign': 'center'}},
+    {'selector': 'node.compound', 'style': {
+        'border-width': 0.5, 'background-color': 'data(color)', 'shape': 'ellipse', 'text-valign': 'top'}},
+    {'selector': 'node.map', 'style': {
+        'border-width': 1, 'shape': 'roundrectangle', 'text-wrap': 'wrap', 'background-color': '#adf',
+        'text-max-width': 'data(text_max_width)', 'text-valign': 'center'}},
+    {'selector': 'node.group', 'style': {'content': '', 'background-opacity': 0, 'border-opacity': 0}},
+    {'selector': 'edge', 'style': {
+        'width': 1, 'curve-style': 'bezier', 'line-color': '#777', 'target-arrow-color': '#777',
+        'line-style': 'solid', 'target-arrow-shape': 'triangle'}},
+    {'selector': 'edge.inhibition', 'style': {'target-arrow-shape': 'tee'}},
+    {'selector': 'edge.indirect', 'style': {'line-style': 'dashed', 'line-color': '#bbb', 'target-arrow-color': '#bbb'}},
+]
+
+
+def pathway_nodes(path_genes):
+    """ Cytoscape nodes of a <pathway>_pathway.csv node table, read column by column """
+    columns = [path_genes['Unnamed: 0'].tolist(),
+               path_genes['labels'].fillna('').tolist(),
+               path_genes['mol.col'].fillna('').tolist(),
+               path_genes['type'].tolist()] + \
+              [path_genes[c].tolist() for c in ['width', 'height', 'x', 'y']]
+
+    return [{'data': {'id': str(i), 'label': str(lab), 'width': float(w), 'height': float(h), 'color': str(col)},
+             'position': {'x': float(x), 'y': float(y)},
+             'classes': 'compound' if t == 'compound' else 'gene'}
+            for i, lab, col, t, w, h, x, y in zip(*columns)]
+
+
+def read_pathway_nodes(path_view_gene):
+    if not isfile(path_view_gene):
+        return []
+    log.debug('Generating graph for {}'.format(path_view_gene))
+    count_input(path_view_gene)
+    return pathway_nodes(pd.read_csv(path_view_gene))
+
+
+def parse_kegg_xml(xml_path):
+    """ Map and group nodes and relation edges of a KEGG pathway XML. Streamed with iterparse,
+    keeping only the entry, relation and first child attributes. """
+    count_input(xml_path)
+    nodes, edges = [], []
+    parent, first_child = None, None
+
+    for event, el in ET.iterparse(xml_path, events=('start', 'end')):
+        if event == 'start':
+            if el.tag in ('entry', 'relation'):
+                parent, first_child = dict(el.attrib), None
+            elif parent is not None and first_child is None:
+                first_child = dict(el.attrib)
+            continue
+
+        if el.tag == 'relation' and first_child is not None:
+            b, e = parent['entry1'], parent['entry2']
+            edges.append({
+                'data': {'id': b + '_' + e, 'source': b, 'target': e},
+                'classes': relation_classes.get(first_child.get('name'), 'relation'),
+            })
+
+        if el.tag == 'entry' and first_child is not None and parent.get('type') in ('map', 'group'):
+            node = {
+                'data': {
+                    'id': parent['id'],
+                    'width': float(first_child['width']),
+                    'height': float(first_child['height']),
+                },
+                'position': {'x': float(first_child['x']), 'y': float(first_child['y'])},
+                'classes': parent['type'],
+            }
+            if parent['type'] == 'map':
+                lab = first_child.get('name', '')
+                if lab[0:5] == 'TITLE':
+                    lab = lab[6:].upper()
+                node['data']['label'] = lab
+                node['data']['text_max_width'] = 0.9 * node['data']['width']
+            nodes.append(node)
+
+        if el.tag in ('entry', 'relation'):
+            parent = None
+            el.clear()
+
+    return nodes, edges
+
+
+def topology_elements(topology):
+    """ Nodes and edges of a shared pathway topology. Cytoscape rejects edges
+    to missing nodes and duplicate ids, so those are dropped. """
+    node_ids = topology['nodes']
+    edges = OrderedDict((e['data']['id'], e) for e in topology['edges']
+                        if e['data']['source'] in node_ids and e['data']['target'] in node_ids)
+    return list(topology['nodes'].values()) + list(edges.values())
+
+
+def build_pathway_payload(task):
+    """ Gene nodes per contrast and the KEGG topology of one pathway. task is
+    (pw_name, [(contrast_name, pw_dir), ...]); runs in a worker process. The topology
+    is shared by all contrasts, so only the XML of the first contrast with nodes is parsed.
+    Returns (pw_name, payload, bytes of the files read). """
+    pw_name, contrast_dirs = task
+    gene_nodes = OrderedDict()
+    xml_path = None
+    with input_counter() as counter:
+        for contrast_name, pw_dir in contrast_dirs:
+            nodes = read_pathway_nodes(join(pw_dir, pw_name + '_pathway.csv'))
+            if nodes:
+                gene_nodes[contrast_name] = nodes
+                if xml_path is None:
+                    xml_path = join(pw_dir, pw_name + '.xml')
+
+        xml_nodes, edges = parse_kegg_xml(xml_path) if xml_path else ([], [])
+    return pw_name, (xml_nodes, edges, gene_nodes), counter['input_bytes']
+
+
+def parallel_map(func, items, workers):
+    """ list(map(func, items)) on a process pool of the given size. Falls back to a serial
+    map when the pool cannot be started or breaks; exceptions of func are raised as they are. """
+    workers = min(int(workers), len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+
+    try:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    except (OSError, NotImplementedError) as e:
+        log.warning('Could not start a process pool, falling back to serial: {}'.format(e))
+        return [func(item) for item in items]
+
+    with pool:
+        try:
+            # the worker processes are started on submission
+            results = pool.map(func, items, chunksize=max(1, len(items) // (workers * 4)))
+        except (OSError, BrokenProcessPool) as e:
+            log.warning('Could not start a process pool, falling back to serial: {}'.format(e))
+        else:
+            try:
+                return list(results)
+            except BrokenProcessPool as e:
+                log.warning('Process pool broke, falling back to serial: {}'.format(e))
+    return [func(item) for item in items]
+
 
+@profiled()
 class MultiqcModule(BaseMultiqcModule):
 
     def pathway_enrichment_heatmap(self, pw):
@@ -36,236 +195,66 @@ class MultiqcModule(BaseMultiqcModule):
             description='Shows enrichment score for different contrasts'
         )
 
-    def single_graph_code(self, pw_name, graph_id, pw_dir):
-
-        elem, cy_style = '', ''
-
-        path_view_gene = join(pw_dir, pw_name + '_pathway.csv')
-        print(path_view_gene)
-        if isfile(path_view_gene):
-            path_genes = pd.read_csv(path_view_gene)
-        else:
-            return elem, cy_style
-
-
-
-        for g in path_genes.iterrows():
-            node_id = str(g[1].T['Unnamed: 0'])
-            x = str(g[1].T['x'])
-            y = str(g[1].T['y'])
-            lab = g[1].T['labels']
-            color = g[1].T['mol.col']
-            wid = str(g[1].T['width'])
-            hei = str(g[1].T['height'])
-
-            shape = 'rectangle'
-            tvalign = 'center'
-            if g[1].T['type'] == 'compound':
-                shape = 'ellipse'
-                tvalign = 'top'
-
-            elem += '{ ' + \
-                    'data: {id: "' + graph_id + '_' + node_id + '"},' + \
-                    'classes: "graph_' + graph_id + '",' + \
-                    'position:{ x:' + x + ',y:' + y + '}' + \
-                    '},'
-
-            cy_style += '{' \
-                        'selector: "#' + graph_id + '_' + node_id + '", ' + \
-                        'style: {' + \
-                        '"content": "' + lab + '",' + \
-                        '"width": "' + wid + '",' + \
-                        '"height": "' + hei + '",' + \
-                        '"border-width": 0.5,' + \
-                        '"font-size": 10,' + \
-                        '"border-style": "solid",' + \
-                        '"border-color": "#333",' + \
-                        '"background-color": "' + color + '",' + \
-                        '"shape": "'+shape+'",' + \
-                        '"text-valign": "' +tvalign+ '"' + \
-                        '}},'
-
-        xml_path = join(pw_dir, pw_name + '.xml')
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
-
-
-        for el in root:
-            if el.tag == 'relation':
-                try:
-                    el_cont = iter(el).__next__()
-
-                    b = graph_id + '_' + el.attrib['entry1']
-                    e = graph_id + '_' + el.attrib['entry2']
-
-                    if el_cont.attrib['name']=='inhibition':
-                        ln_style ='solid'
-                        color = '#777'
-                        arr_shape = 'tee'
-
-                    elif el_cont.attrib['name']=='indirect effect':
-                        ln_style ='dashed'
-                        color = '#bbb'
-                        arr_shape = 'triangle'
-
-                    else:
-                        ln_style ='solid'
-                        color = '#777'
-                        arr_shape = 'triangle'
-
-                    elem += '{ ' + \
-                            'classes: "relation graph_' + graph_id + '", ' + \
-                            'data: {id: "' + b + '_' + e + '", source: "' + b + '",' + 'target: "' + e + '"}' + \
-                            '},'
-
-                    cy_style += '{' + \
-                                'selector: "#' + b + '_' + e + '",' + \
-                                'style: {' + \
-                                '"width": 1,' + \
-                                '"curve-style": "bezier",' + \
-                                '"line-color": "'+color+'",' + \
-                                '"target-arrow-color": "'+color+'",' + \
-                                '"line-style": "'+ln_style+'",' + \
-                                '"target-arrow-shape": "'+arr_shape+'"' + \
-                                '}},'
-                except StopIteration:
-                    continue
-
-            if el.attrib['type'] == 'map':
-                el_cont = iter(el).__next__()
-
-                node_id = el.attrib['id']
-                x = el_cont.attrib['x']
-                y = el_cont.attrib['y']
-                wid = el_cont.attrib['width']
-                hei = el_cont.attrib['height']
-                if 'name' in el_cont.attrib:
-                    lab = el_cont.attrib['name']
-
-                if lab[0:5]=='TITLE':
-                    lab=lab[6:].upper()
-
-
-                elem += '{ ' + \
-                        'data: {id: "' + graph_id + '_' + node_id + '"},' + \
-                        'classes: "graph_' + graph_id + '",' + \
-                        'position:{ x:' + x + ',y:' + y + '}' + \
-                        '},'
-
-                cy_style += '{' \
-                            'selector: "#' + graph_id + '_' + node_id + '", ' + \
-                            'style: {' + \
-                            '"content": "' + lab + '",' + \
-                            '"width": "' + wid + '",' + \
-                            '"height": "' + hei + '",' + \
-                            '"border-width": 1,' + \
-                            '"font-size": 10,' + \
-                            '"border-style": "solid",' + \
-                            '"border-color": "#333",' + \
-                            '"shape": "roundrectangle",' + \
-                            '"text-wrap": "wrap",' + \
-                            '"background-color": "#adf",' + \
-                            '"text-max-width": '+ str(0.9 * int(wid)) + ',' + \
-                            '"text-valign": "center"' + \
-                            '}},'
-
-            if el.attrib['type'] == 'group':
-                el_cont = iter(el).__next__()
-
-                node_id = el.attrib['id']
-                x = el_cont.attrib['x']
-                y = el_cont.attrib['y']
-                wid = el_cont.attrib['width']
-                hei = el_cont.attrib['height']
-
-                elem += '{ ' + \
-                        'data: {id: "' + graph_id + '_' + node_id + '"},' + \
-                        'classes: "graph_' + graph_id + '",' + \
-                        'position:{ x:' + x + ',y:' + y + '}' + \
-                        '},'
-
-                cy_style += '{' \
-                            'selector: "#' + graph_id + '_' + node_id + '", ' + \
-                            'style: {' + \
-                            '"width": "' + wid + '",' + \
-                            '"background-opacity": 0,' + \
-                            '"border-opacity": 0,' + \
-                            '"height": "' + hei + '",' + \
-                            '}},'
-
-
-        return elem, cy_style
-
     def pathway_graphs(self, all_pw_dir, pw):
 
-        cy_style = 'style: ['
-        elem = 'elements: ['
-
-        btnGroup = ''
-        btnFun = ''
-        hidGr = ''
-        firstBtn_id = ''
-
-
+        # Gene nodes and KEGG topology of each pathway, one task per pathway
+        tasks = OrderedDict()
         for contrast_name in all_pw_dir:
-            pw_dir = all_pw_dir[contrast_name]
+            for pw_it in pw[contrast_name].index.tolist():
+                tasks.setdefault(str(pw_it), []).append((contrast_name, all_pw_dir[contrast_name]))
+        results = parallel_map(build_pathway_payload, list(tasks.items()),
+                               get_az_config('fa_workers', os.cpu_count() or 1))
+        # files read in worker processes are counted there and added here
+        add_input_bytes(sum(input_bytes for _, _, input_bytes in results))
+        payloads = {pw_name: payload for pw_name, payload, _ in results}
+
+        # One shared topology per pathway, per-contrast node colours on top
+        pathways = OrderedDict()
+        graphs = OrderedDict()
+        btn_groups = []
 
-            pw_list = pw[contrast_name].index.tolist()
-            btnGroup += '<li><p >' + contrast_name + '</p>'
-            for pw_it in pw_list:
+        for contrast_name in all_pw_dir:
+            buttons = []
+            for pw_it in pw[contrast_name].index.tolist():
                 pw_name = str(pw_it)
-
                 graph_id = contrast_name + '_' + pw_name
-                print('generating graph for')
-                print([pw_name, graph_id, pw_dir])
-                new_elem, new_cy_style = self.single_graph_code(pw_name, graph_id, pw_dir)
-
-                if new_elem != '':
-
-                    if len(btnFun)==0:
-                        firstBtn_id = graph_id
-
-                    elem += new_elem + '\n'
-                    cy_style += new_cy_style + '\n'
-
-                    btnGroup += '<button id="' + graph_id + '" onclick="show_' + graph_id + '()" class="inact">' + pw_name + '</button>'
-                    hidGr += 'var hid_' + graph_id + ' = cy.remove(".graph_' + graph_id + '");'
-                    btnFun += 'function show_' + graph_id + '(){ cy.remove(":inside"); hid_' + graph_id + '.restore(); \
-                            var x = document.getElementsByClassName("act"); var i; for (i = 0; i < x.length; i++)  { x[i].className = "inact";} \
-                            var x = document.getElementsByClassName("preact"); var i; for (i = 0; i < x.length; i++)  { x[i].className = "inact";} '
-
-                    for c in [*all_pw_dir]:
-                        btnFun += 'document.getElementById("' + c + '_' + pw_name + '").className = "preact"; '
+                xml_nodes, edges, gene_nodes_by_contrast = payloads[pw_name]
+                gene_nodes = gene_nodes_by_contrast.get(contrast_name)
+                if not gene_nodes:
+                    continue
 
-                    btnFun += 'document.getElementById("' + graph_id + '").className = "act";    };'
+                if pw_name not in pathways:
+                    pathways[pw_name] = {'nodes': OrderedDict((n['data']['id'], n) for n in xml_nodes), 'edges': edges}
+                topology_nodes = pathways[pw_name]['nodes']
 
+                colors = OrderedDict()
+                for node in gene_nodes:
+                    colors[node['data']['id']] = node['data'].pop('color')
+                    topology_nodes.setdefault(node['data']['id'], node)
 
+                graphs[graph_id] = {'pathway': pw_name, 'colors': colors}
+                buttons.append('<button class="inact" data-graph="{}" data-pathway="{}">{}</button>'.format(
+                    graph_id, pw_name, pw_name))
 
+            btn_groups.append('<li><p>' + contrast_name + '</p>' + ''.join(buttons) + '</li>')
 
-            btnGroup += '</li>'
+        if not graphs:
+            return
 
-        # remove last character: ','
-        elem = elem[:-1]
-        cy_style = cy_style[:-1]
-        btnGroup = btnGroup[:-5]
+        graphs_json = json.dumps({
+            'style': graph_style,
+            'pathways': OrderedDict((pw_name, topology_elements(t)) for pw_name, t in pathways.items()),
+            'graphs': graphs,
+        }).replace('</', '<\\/')
 
-        elem += ']'
-        cy_style += ']'
+        with open(join(dirname(abspath(__file__)), 'pathway_graph.txt')) as f:
+            script = f.read()
 
         cyto_scape_path = '<script src="https://cdnjs.cloudflare.com/ajax/libs/cytoscape/3.2.7/cytoscape.js"></script>'
-        div_style = "<style> #cy { width: 100%; height: 900px; position: relative; top: 0px; left: 0px; } </style>"
-        btn_style = '<style>.inact {  font-size: 14px; margin: 2px;   background-color: #e7e7e7;    border: none;    color: black;    padding: 6px 32px;    text-align: center;    text-decoration: none;    display: inline-block;} \
-                            .preact {  font-size: 14px;  margin: 2px;  background-color: #d0f0c0;    border: none;    color: black;    padding: 6px 32px;    text-align: center;    text-decoration: none;    display: inline-block; } \
-                             .act {  font-size: 14px;  margin: 2px;  background-color: #4CAF50;    border: none;    color: white;    padding: 6px 32px;    text-align: center;    text-decoration: none;    display: inline-block; }</style>'
-        layout = 'layout: {    name: "preset"  }'
-
-        open_first_graph = 'window.onload=show_'+firstBtn_id+';'
-
-        # construct graph html
-        graph_html = div_style + btn_style + btnGroup + '<div id="cy"></div>' + cyto_scape_path + \
-                     '<script> var cy = cytoscape({container: document.getElementById("cy"), ' + \
-                     'minZoom: 0.5, maxZoom: 2,' + \
-                     elem + ',' + layout + ',' + cy_style + ' });' + hidGr + btnFun + open_first_graph + '</script>'
+        graph_html = '<ul id="bcbio_rnaseq_fa-buttons" style="list-style: none; padding: 0;">' + ''.join(btn_groups) + '</ul>' + \
+                     '<div id="cy"></div>' + cyto_scape_path + \
+                     '<script type="application/json" id="bcbio_rnaseq_fa-graphs">' + graphs_json + '</script>' + \
+                     script
 
         self.add_section(
             name='Pathway detalization',
@@ -273,22 +262,20 @@ class MultiqcModule(BaseMultiqcModule):
             content=graph_html,
         )
 
-
-
     def __init__(self):
 
         mod_name = 'bcbio_rnaseq_fa'
 
         super(MultiqcModule, self).__init__(name='DE genes pathways', anchor=mod_name)
         # make dict of pathway tables per contrast
-        pw = {}
-        pw_dir = {}
+        files = OrderedDict()
+        pw_dir = OrderedDict()
 
         for f in self.find_log_files('bcbio_rnaseq_fa/pathway_table', filecontents=False):
             contrast = f['root'].split('/')
-            data = pd.read_csv(join(f['root'], f['fn']), usecols=[0,1,3,6], index_col=[0])
-            pw[contrast[-1]] = data
-            pw_dir[contrast[-1]] = dirpath
+            files[contrast[-1]] = (join(f['root'], f['fn']), {'usecols': [0, 1, 3, 6], 'index_col': [0]})
+            pw_dir[contrast[-1]] = f['root']
+        pw = load_tables(files)
 
         if not pw:
             log.debug("Could not find files for bcbioRNAseq-FA in {}".format(config.analysis_dir))
@@ -296,7 +283,3 @@ class MultiqcModule(BaseMultiqcModule):
 
         self.pathway_enrichment_heatmap(pw)
         self.pathway_graphs(pw_dir, pw)
-
-        if not de:
-            log.debug("Could not find files for bcbioRNAseq-DE in {}".format(config.analysis_dir))
-            raise UserWarning
@@ -1,19 +1,315 @@
 """ MultiQC module to parse output from bcbioRNASeq Quality control """
 
-import plotly as py
-import pandas as pd
-import plotly.graph_objs as go
-import scipy.stats as st
-from os.path import join
+import re
+from html import escape
+from os.path import join, dirname, abspath
+from collections import OrderedDict
 from multiqc.modules.base_module import BaseMultiqcModule
 from multiqc.plots import scatter, heatmap
 from multiqc import config
+from multiqc_az.utils import get_az_config, assign_colors, lazy_import
+from multiqc_az.loader import load_tables, iter_gene_table_chunks
+from multiqc_az.plotly_assets import require_plotlyjs, to_json
+from multiqc_az.profiling import profiled
 import logging
 
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+go = lazy_import('plotly.graph_objs')
+
 # Initialise the logger
 log = logging.getLogger(__name__.replace('multiqc_az', 'multiqc'))
 
-
+correlation_methods = {
+    'pearson': 'Pearson',
+    'spearman': 'Spearman',
+}
+
+
+def correlation_matrix(counts, method='pearson', log_transform=False, chunk_size=None):
+    """ All-pairs correlation between the columns of a genes x samples matrix.
+    The cross products of the centered columns are summed over blocks of chunk_size
+    genes, so only one block at a time is converted to float64. Spearman ranks
+    need whole columns and are computed on the full matrix first. """
+    if method not in correlation_methods:
+        raise ValueError('Unknown correlation method: {}'.format(method))
+
+    values = np.asarray(counts)
+    if method == 'spearman':
+        # ranks are the same with or without the log transform
+        values = pd.DataFrame(values).rank(axis=0).values
+        log_transform = False
+
+    n_genes = len(values)
+    chunk_size = chunk_size or max(n_genes, 1)
+
+    def blocks():
+        for start in range(0, n_genes, chunk_size):
+            block = np.asarray(values[start:start + chunk_size], dtype=np.float64)
+            yield np.log2(block + 1) if log_transform else block
+
+    # exact column means first, so the cross products are taken around them
+    mean = sum(block.sum(axis=0) for block in blocks()) / n_genes
+    acc = CorrelationAccumulator(shift=mean)
+    for block in blocks():
+        acc.add(block)
+    return acc.result()
+
+
+class CorrelationAccumulator(object):
+    """ Pearson correlation between the columns of a matrix fed in row chunks. Sums are taken
+    around the given column means, or the first chunk's, to avoid cancellation in the cross products. """
+
+    def __init__(self, shift=None):
+        self.n = 0
+        self.shift = shift
+        self.sums = None
+        self.cross = None
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        if self.shift is None:
+            self.shift = values.mean(axis=0)
+        if self.cross is None:
+            self.sums = np.zeros(values.shape[1])
+            self.cross = np.zeros((values.shape[1], values.shape[1]))
+        values = values - self.shift
+        self.n += len(values)
+        self.sums += values.sum(axis=0)
+        self.cross += values.T.dot(values)
+
+    def result(self):
+        cov = self.cross - np.outer(self.sums, self.sums) / self.n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sd = np.sqrt(np.diag(cov))
+            cor = cov / np.outer(sd, sd)
+        return np.clip(cor, -1, 1)
+
+
+class BiotypeDistributions(object):
+    """ Per (biotype, sample) TPM distributions accumulated as log-spaced histograms plus exact
+    minimum and maximum, so memory does not depend on the number of genes. Quartiles are
+    interpolated within their bin (bins are 6% wide), whiskers are the 1.5 IQR fences
+    clipped to the data range. The values of biotypes with at most exact_max_genes genes
+    are kept as well, and their statistics are computed exactly as in memory, since
+    the interpolated quartiles are off by tens of percent on small groups. """
+
+    bins_per_decade = 40
+    min_exp = -3
+    max_exp = 6
+    exact_max_genes = 1000
+
+    def __init__(self, biotypes, samples):
+        self.biotypes = list(biotypes)
+        self.samples = list(samples)
+        self.edges = np.logspace(self.min_exp, self.max_exp, (self.max_exp - self.min_exp) * self.bins_per_decade + 1)
+        # bin 0 holds values below the first edge (including zeros), the last bin values above the last edge
+        self.hist = np.zeros((len(self.biotypes), len(self.samples), len(self.edges) + 1), dtype=np.int64)
+        self.min = np.full(self.hist.shape[:2], np.inf)
+        self.max = np.full(self.hist.shape[:2], -np.inf)
+        self.exact = {code: [] for code in range(len(self.biotypes))}
+
+    def add(self, codes, values):
+        """ codes: biotype index of each gene, values: genes x samples array """
+        n_types, n_samples, n_bins = self.hist.shape
+        codes = np.asarray(codes, dtype=np.int64)
+        bins = np.searchsorted(self.edges, values, side='right')
+        flat = (codes[:, None] * n_samples + np.arange(n_samples)[None, :]) * n_bins + bins
+        self.hist += np.bincount(flat.ravel(), minlength=self.hist.size).reshape(self.hist.shape)
+
+        grouped = pd.DataFrame(values).groupby(codes)
+        present = grouped.min().index.values
+        self.min[present] = np.fmin(self.min[present], grouped.min().values)
+        self.max[present] = np.fmax(self.max[present], grouped.max().values)
+
+        for code in present:
+            if code in self.exact:
+                if self.hist[code, 0].sum() > self.exact_max_genes:
+                    del self.exact[code]
+                else:
+                    self.exact[code].append(values[codes == code])
+
+    def quantile(self, q):
+        cum = self.hist.cumsum(axis=2)
+        target = q * cum[..., -1]
+        k = (cum < target[..., None]).sum(axis=2)
+        k = np.minimum(k, self.hist.shape[2] - 1)
+        before = np.take_along_axis(cum, k[..., None], axis=2)[..., 0] - np.take_along_axis(self.hist, k[..., None], axis=2)[..., 0]
+        count = np.take_along_axis(self.hist, k[..., None], axis=2)[..., 0]
+        log_edges = np.log10(self.edges)
+        lo = log_edges[np.clip(k - 1, 0, len(log_edges) - 1)]
+        hi = log_edges[np.clip(k, 0, len(log_edges) - 1)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            value = 10 ** (lo + (target - before) / count * (hi - lo))
+        value = np.where(k == 0, self.min, value)
+        value = np.where(k == self.hist.shape[2] - 1, self.max, value)
+        return np.clip(value, self.min, self.max)
+
+    def box_stats(self):
+        """ DataFrame indexed by (biotype, sample) with q1, median, q3, lowerfence and upperfence """
+        q1, median, q3 = self.quantile(0.25), self.quantile(0.5), self.quantile(0.75)
+        iqr = q3 - q1
+        stats = pd.DataFrame({
+            'q1': q1.ravel(),
+            'median': median.ravel(),
+            'q3': q3.ravel(),
+            'lowerfence': np.maximum(q1 - 1.5 * iqr, self.min).ravel(),
+            'upperfence': np.minimum(q3 + 1.5 * iqr, self.max).ravel(),
+        }, index=pd.MultiIndex.from_product([self.biotypes, self.samples], names=['biotype', 'sample']))
+        stats = stats[self.hist.sum(axis=2).ravel() > 0]
+
+        exact = [(self.biotypes[code], np.concatenate(v)) for code, v in self.exact.items() if v]
+        if exact:
+            tpm = pd.DataFrame(np.concatenate([v for _, v in exact]), columns=self.samples)
+            labels = np.repeat([b for b, _ in exact], [len(v) for _, v in exact])
+            exact_stats, _ = biotype_box_stats(tpm, labels, max_outliers=0)
+            stats.update(exact_stats)
+        return stats
+
+
+def biotype_box_stats(tpm, biotypes, max_outliers=50):
+    """ Box statistics of a genes x samples table per (biotype, sample), from one groupby
+    over all samples at once. Whiskers are the most extreme values within 1.5 IQR of the
+    quartiles; at most max_outliers of the values beyond them are kept per (biotype, sample). """
+    quartiles = tpm.groupby(biotypes).quantile([0.25, 0.5, 0.75])
+    quartiles.index.names = ['biotype', 'q']
+    quartiles = quartiles.stack().unstack('q')
+    quartiles.index.names = ['biotype', 'sample']
+    q1, q3 = quartiles[0.25], quartiles[0.75]
+    iqr = q3 - q1
+
+    # Fences of each gene's biotype, aligned with the genes x samples table
+    lo = (q1 - 1.5 * iqr).unstack('sample').reindex(biotypes)[tpm.columns].values
+    hi = (q3 + 1.5 * iqr).unstack('sample').reindex(biotypes)[tpm.columns].values
+    inside = (tpm.values >= lo) & (tpm.values <= hi)
+
+    stats = pd.DataFrame({
+        'q1': q1,
+        'median': quartiles[0.5],
+        'q3': q3,
+        'lowerfence': tpm.where(inside).groupby(biotypes).min().stack(),
+        'upperfence': tpm.where(inside).groupby(biotypes).max().stack(),
+    })
+    stats.index.names = ['biotype', 'sample']
+
+    gene_idx, sample_idx = np.nonzero(~inside & tpm.notnull().values)
+    outliers = pd.DataFrame({
+        'biotype': np.asarray(biotypes)[gene_idx],
+        'sample': tpm.columns.values[sample_idx],
+        'tpm': tpm.values[gene_idx, sample_idx],
+    })
+    medians = quartiles[0.5].reindex(pd.MultiIndex.from_arrays([outliers['biotype'], outliers['sample']])).values
+    outliers['distance'] = np.abs(outliers['tpm'] - medians)
+    outliers = outliers.sort_values('distance', ascending=False).groupby(['biotype', 'sample']).head(max_outliers)
+    return stats, outliers.drop(columns='distance').sort_values(['sample', 'biotype'])
+
+
+def gene_biotypes(biotype, genes):
+    """ Biotype of each of the genes from the gene2biotype table: the last one given for a
+    gene, 'NA' for genes missing from the annotation, NaN for genes annotated with an empty one """
+    gene_biotype = biotype.gene_biotype.astype(object)[~biotype.index.duplicated(keep='last')]
+    return gene_biotype.reindex(genes).where(genes.isin(gene_biotype.index), 'NA')
+
+
+def pca_columns(pca_data, max_pcs=5):
+    """ The pc1, pc2, ... columns of the PCA table, in PC order """
+    pcs = [c for c in pca_data.columns if re.match(r'^pc\d+$', str(c), re.IGNORECASE)]
+    return sorted(pcs, key=lambda c: int(str(c)[2:]))[:max_pcs]
+
+
+def pca_traces(pca_data, pcs, scatter_cls=None):
+    """ One trace per condition, with the coordinates of its samples on every PC """
+    scatter_cls = scatter_cls or go.Scattergl
+    group_col = next((c for c in ['condition', 'group'] if c in pca_data.columns), None)
+    conditions = pca_data[group_col].astype(str).values if group_col else np.full(len(pca_data), 'samples')
+    color_by_cond = assign_colors(conditions)
+    names = np.asarray(pca_data.index.astype(str))
+    values = {pc: np.asarray(pca_data[pc], dtype=np.float64) for pc in pcs}
+
+    codes, uniques = pd.factorize(conditions)
+    traces = []
+    for i, cond in enumerate(uniques):
+        rows = codes == i
+        trace = scatter_cls(mode='markers', name=cond, text=names[rows].tolist(),
+                            marker={'size': 10, 'color': color_by_cond[cond]})
+        traces.append({'trace': trace.to_plotly_json(),
+                       'pcs': {pc.lower(): values[pc][rows].tolist() for pc in pcs}})
+    return traces
+
+
+def pca_plot(div_id, traces, pcs, height=700):
+    """ Scatter of one PC pair at a time, with selectors for the PCs on each axis """
+    spec = {
+        'layout': go.Layout(height=height, hovermode='closest').to_plotly_json(),
+        'traces': traces,
+    }
+    require_plotlyjs()
+
+    with open(join(dirname(abspath(__file__)), 'pca_plot.txt')) as f:
+        script = f.read()
+
+    def select(axis, selected):
+        options = ''.join('<option value="{}"{}>{}</option>'.format(
+            pc.lower(), ' selected' if pc == selected else '', pc.upper()) for pc in pcs)
+        return '<label style="margin-right: 20px;">' + axis + ': <select id="' + div_id + '-' + axis + '" ' + \
+            'class="form-control input-sm" style="display: inline-block; width: auto;">' + options + '</select></label>'
+
+    return script + \
+        '<div>' + select('x', pcs[0]) + select('y', pcs[1]) + '</div>' + \
+        '<div id="' + div_id + '" style="height: ' + str(height) + 'px;"></div>' + \
+        '<script type="application/json" id="' + div_id + '-data">' + to_json(spec) + '</script>' + \
+        '<script> $(function(){ mqcAzPlotly(function(){ mqcAzPcaPlot("' + div_id + '"); }); }); </script>'
+
+
+box_stat_columns = ['q1', 'median', 'q3', 'lowerfence', 'upperfence']
+
+
+def biotype_box_plot(div_id, stats, outliers=None, height=500):
+    """ Box plot per biotype of one sample at a time, from statistics precomputed per
+    (biotype, sample), with a selector for the sample. The statistics of every sample
+    are embedded once and the figure is redrawn when another sample is selected. """
+    samples = stats.index.get_level_values('sample').unique().tolist()
+    biotypes = stats.index.get_level_values('biotype').unique().tolist()
+    by_sample = {col: stats[col].unstack('biotype').reindex(index=samples, columns=biotypes).values
+                 for col in box_stat_columns}
+    outliers_by_sample = dict(list(outliers.groupby('sample'))) if outliers is not None else {}
+    code_by_biotype = {b: i for i, b in enumerate(biotypes)}
+
+    sample_specs = []
+    for i, sample in enumerate(samples):
+        present = ~np.isnan(by_sample['median'][i])
+        sample_spec = {'name': sample, 'x': np.flatnonzero(present).tolist()}
+        for col in box_stat_columns:
+            sample_spec[col] = by_sample[col][i][present].tolist()
+        sample_outliers = outliers_by_sample.get(sample)
+        sample_spec['outliers_x'] = sample_outliers['biotype'].map(code_by_biotype).tolist() if sample_outliers is not None else []
+        sample_spec['outliers_y'] = sample_outliers['tpm'].tolist() if sample_outliers is not None else []
+        sample_specs.append(sample_spec)
+
+    spec = {
+        'layout': go.Layout(yaxis=dict(type='log', autorange=True), showlegend=False, height=height).to_plotly_json(),
+        'box': go.Box().to_plotly_json(),
+        'outliers': go.Scatter(mode='markers', marker={'size': 4, 'color': '#666'}).to_plotly_json(),
+        'biotypes': biotypes,
+        'samples': sample_specs,
+    }
+    require_plotlyjs()
+
+    with open(join(dirname(abspath(__file__)), 'box_plot.txt')) as f:
+        script = f.read()
+
+    options = ''.join('<option value="{}">{}</option>'.format(i, escape(str(sample))) for i, sample in enumerate(samples))
+    return script + \
+        '<div><label>Sample: <select id="' + div_id + '-sample" class="form-control input-sm" ' + \
+        'style="display: inline-block; width: auto;">' + options + '</select></label></div>' + \
+        '<div id="' + div_id + '" style="height: ' + str(height) + 'px;"></div>' + \
+        '<script type="application/json" id="' + div_id + '-data">' + to_json(spec) + '</script>' + \
+        '<script> $(function(){ mqcAzPlotly(function(){ mqcAzBoxPlot("' + div_id + '"); }); }); </script>'
+
+
+@profiled()
 class MultiqcModule(BaseMultiqcModule):
 
     def __init__(self):
@@ -23,104 +319,76 @@ class MultiqcModule(BaseMultiqcModule):
         # Initialise the parent object
         super(MultiqcModule, self).__init__(name='bcbiornaseqqc', anchor=mod_name)
 
-        raw_counts = None
-        norm_counts = None
-        raw_data = None
-        pca_data = None
-        tpm = None
-        biotype = None
-
-        for f in self.find_log_files('bcbio_rnaseq_qc/raw_counts', filecontents=False):
-            fpath = join(f['root'], f['fn'])
-            raw_counts = pd.read_csv(fpath)
-
-        for f in self.find_log_files('bcbio_rnaseq_qc/normalized_counts', filecontents=False):
-            fpath = join(f['root'], f['fn'])
-            norm_counts = pd.read_csv(fpath)
-
-        for f in self.find_log_files('bcbio_rnaseq_qc/cormatrix', filecontents=False):
-            fpath = join(f['root'], f['fn'])
-            raw_data = pd.read_csv(fpath)
-
-        for f in self.find_log_files('bcbio_rnaseq_qc/pca', filecontents=False):
-            fpath = join(f['root'], f['fn'])
-            pca_data = pd.read_csv(fpath, index_col=[0])
-
-        for f in self.find_log_files('bcbio_rnaseq_qc/tpm', filecontents=False):
-            fpath = join(f['root'], f['fn'])
-            tpm = pd.read_csv(fpath, index_col=[0])
-
-        for f in self.find_log_files('bcbio_rnaseq_qc/gene2biotype', filecontents=False):
-            fpath = join(f['root'], f['fn'])
-            biotype = pd.read_csv(fpath, index_col=[0])
-
-        if raw_counts is None:
+        files = OrderedDict()
+        for key, read_kwargs in [('raw_counts', {'float32': True}),
+                                 ('normalized_counts', {'float32': True}),
+                                 ('cormatrix', {}),
+                                 ('pca', {'index_col': [0]}),
+                                 ('tpm', {'float32': True, 'index_col': [0]}),
+                                 ('gene2biotype', {'index_col': [0]})]:
+            for f in self.find_log_files('bcbio_rnaseq_qc/' + key, filecontents=False):
+                files[key] = (join(f['root'], f['fn']), read_kwargs)
+
+        if 'raw_counts' not in files:
             log.debug("Could not find data for bcbioRNAseq-QC in {}".format(config.analysis_dir))
             raise UserWarning
 
-        col_names = list(raw_counts)[1:]
-        group_num = len(col_names)
+        # In streaming mode the gene-level tables are only read in chunks, keeping peak memory bounded
+        streaming = get_az_config('streaming', False)
+        gene_tables = ['raw_counts', 'normalized_counts', 'tpm']
+        tables = load_tables(OrderedDict((k, v) for k, v in files.items() if not (streaming and k in gene_tables)))
+        raw_data = tables.get('cormatrix')
+        pca_data = tables.get('pca')
+        biotype = tables.get('gene2biotype')
+
+        if streaming:
+            chunk_size = get_az_config('chunk_size', 10000)
+            self.plot_correlation_heatmap_streaming(files['raw_counts'][0], files['normalized_counts'][0], chunk_size)
+        else:
+            raw_counts = tables['raw_counts']
+            norm_counts = tables.get('normalized_counts')
 
-        raw_counts['sum'] = raw_counts.sum(axis=1)
+            col_names = list(raw_counts)[1:]
+            group_num = len(col_names)
 
-        self.plot_correlation_heatmap(raw_counts, norm_counts, col_names, group_num)
+            raw_counts['sum'] = raw_counts.sum(axis=1, numeric_only=True)
+
+            self.plot_correlation_heatmap(raw_counts, norm_counts, col_names, group_num)
         #self.plot_mean_sd(raw_counts, norm_counts, col_names, group_num, vst, rlog, combined_counts)
         #self.plot_disp_ests(combined_counts, genes_est,genes_final,genes_fitted)
         self.plot_covariates(raw_data)
         self.plot_pca(pca_data)
-        self.tpm_perbiotype(tpm, biotype)
+        if streaming:
+            self.tpm_perbiotype_streaming(files['tpm'][0], biotype, chunk_size)
+        else:
+            self.tpm_perbiotype(tables['tpm'], biotype)
 
     def plot_pca(self, pca_data):
-
-        print(pca_data)
-        data =[]
-        for name, row in pca_data.iterrows():
-            data.append(go.Scatter(x=[row['pc1']],
-                                   y=[row['pc2']],
-                                   mode = 'markers',
-                                   marker={'size': 10},
-                                   text=[name],
-                                   name=name))
-
-        layout = go.Layout(height=700)
-
-
-
-        fig = go.Figure(data=data, layout=layout)
-
-        tab_content = py.offline.plot(fig, auto_open=False, output_type='div', include_plotlyjs=True)
+        pcs = pca_columns(pca_data)
+        if len(pcs) < 2:
+            log.warning('PCA table has fewer than 2 PC columns, skipping the PCA plot')
+            return
+        tab_content = pca_plot('bcbio_rnaseq_qc-pca', pca_traces(pca_data, pcs), pcs)
 
         self.add_section (
             name = 'PCA plot',
             anchor = 'pca',
-            description = 'PCA is a popular method that is based on the principles of dimensional reduction. Below is a PCA plot of the samples within the space of the first two principal components that explain the most variation in the data. These were calculated using the read counts of the top 1000 most variable genes within the dataset.',
+            description = 'PCA is a popular method that is based on the principles of dimensional reduction. Below is a PCA plot of the samples within the space of the first two principal components that explain the most variation in the data; other pairs of components can be selected above the plot. These were calculated using the read counts of the top 1000 most variable genes within the dataset.',
 
             content = tab_content
         )
 
     def plot_covariates(self, raw_data):
+        """ Correlation of each covariate with each PC, significant (FDR < 0.1) values only """
+        raw_data = raw_data.astype({'compare': str, 'covar': str})
+        comp_names = pd.unique(raw_data['compare']).tolist()
+        cor_names = pd.unique(raw_data['covar']).tolist()
 
-        # find number of PCs
-        pc_num = raw_data['covar'].value_counts().tolist()
-        pc_num = pc_num[0]
-
-        comp_names = []
-        for iter, row in raw_data.iterrows():
-            comp_names.append(row['compare'])
-            if iter % pc_num == 2:
-                break
-
-        cor_names = []
-        for _, row in raw_data.iterrows():
-            if not (row['covar'] in cor_names):
-                cor_names.append(row['covar'])
-
-        hmdata = [[None for _ in range(len(cor_names))] for _ in range(3)]
-        for iter,row in raw_data.iterrows():
-            j = int(iter / pc_num)
-            i = iter % pc_num
-            if row['fdr'] < 0.1:
-                hmdata[i][j] = row['r']
+        significant = raw_data.assign(r=raw_data['r'].where(raw_data['fdr'] < 0.1))
+        matrix = significant.drop_duplicates(['compare', 'covar'], keep='last') \
+            .pivot(index='compare', columns='covar', values='r') \
+            .reindex(index=comp_names, columns=cor_names)
+        hmdata = matrix.astype(object).where(matrix.notnull(), None).values.tolist()
 
         pconfig = {
             'title': "bcbioRNASeq Quality Control: PCA Covariates",                 # Plot title - should be in format "Module Name: Plot Title"
@@ -147,8 +415,30 @@ class MultiqcModule(BaseMultiqcModule):
 
     def plot_correlation_heatmap(self, raw_counts, norm_counts, col_names, group_num):
         norm_counts = norm_counts[raw_counts['sum'] > 0]
-        hmdata = [[st.pearsonr(norm_counts[col_names[i]], norm_counts[col_names[j]])[0]
-                    for i in range(group_num)] for j in range(group_num)]
+        method = get_az_config('correlation_method', 'pearson')
+        hmdata = correlation_matrix(norm_counts[col_names], method=method,
+                                    log_transform=get_az_config('correlation_log', False),
+                                    chunk_size=get_az_config('correlation_chunk_size')).tolist()
+        self.add_correlation_section(hmdata, col_names, method)
+
+    def plot_correlation_heatmap_streaming(self, raw_path, norm_path, chunk_size):
+        method = get_az_config('correlation_method', 'pearson')
+        if method != 'pearson':
+            log.warning('Only Pearson correlation is available in streaming mode')
+            method = 'pearson'
+        log_transform = get_az_config('correlation_log', False)
+
+        acc = CorrelationAccumulator()
+        col_names = None
+        for raw_chunk, norm_chunk in zip(iter_gene_table_chunks(raw_path, chunk_size),
+                                         iter_gene_table_chunks(norm_path, chunk_size)):
+            col_names = list(raw_chunk)
+            values = norm_chunk[col_names].values[raw_chunk.values.sum(axis=1) > 0]
+            acc.add(np.log2(values + 1) if log_transform else values)
+
+        self.add_correlation_section(acc.result().tolist(), col_names, method)
+
+    def add_correlation_section(self, hmdata, col_names, method):
 
         pconfig = {
             'title': "bcbioRNASeq Quality Control: Correlation Heatmap",
@@ -170,7 +460,7 @@ class MultiqcModule(BaseMultiqcModule):
         self.add_section (
             name = 'Correlation Heatmap',
             anchor = 'heatmap_section',
-            description = 'This heatmap shows Pearson`s correlation values between groups.',
+            description = 'This heatmap shows {}`s correlation values between groups.'.format(correlation_methods[method]),
             helptext = 'Inter-correlation analysis (ICA) is another way to look at how well samples cluster by plotting the correlation between the expression profiles of the samples. Pearson`s correlation coefficient is a measure of how well your data would be fitted by a linear regression.',
             plot = hm_html
         )
@@ -178,57 +468,31 @@ class MultiqcModule(BaseMultiqcModule):
     def tpm_perbiotype(self, tpm, biotype):
         samples = list(tpm)
 
-        biotype_dict = biotype.gene_biotype.to_dict()
-
-        biotype_list = []
-        for gene in tpm.index.tolist():
-            if gene in biotype_dict:
-                biotype_list.append(biotype_dict[gene])
-            else:
-                # print('Warning! ' + gene + ' not in biotype_dict')
-                biotype_list.append('NA')
-
-        se = pd.Series(biotype_list)
-
-
+        # genes annotated with an empty biotype are dropped
+        tpm = tpm.assign(biotype=gene_biotypes(biotype, tpm.index).values).dropna()
 
-        tpm.insert(0, 'biotype', se.values)
-        tpm = tpm.dropna()
+        stats, outliers = biotype_box_stats(tpm[samples], tpm['biotype'].values,
+                                            get_az_config('biotype_max_outliers', 50))
+        self.add_biotype_box_section(stats, outliers)
 
-        types = set(tpm.biotype.tolist())
-        groupped = tpm.groupby(by='biotype')
-        tpm_per_biotype_per_sample = {}
-
-        for type in types:
-            g = groupped.get_group(type)
-            tpm_per_sample = {}
-            for sample in samples:
-                tpm_per_sample[sample] = g[sample].tolist()
-
-            tpm_per_biotype_per_sample[type] = tpm_per_sample
-
-        layout = go.Layout(yaxis=dict(type='log', autorange=True, ), showlegend=False, height = 500)
-        link = []
-        for sample in samples:
-            print(sample)
-            data = []
-            for type in types:
-                data.append(go.Box(y=tpm_per_biotype_per_sample[type][sample], name=type))
-
-            fig = go.Figure(data=data, layout=layout)
-            fig['layout'].update(title=sample)
-
-
-            link.append(py.offline.plot(fig, auto_open=False, output_type='div', include_plotlyjs=False))
-
-        html_string=''
-        for l in link:
-            html_string += '''<div style="width:50%; display:inline-block" frameborder="0" seamless="seamless" scrolling="no">''' + l + '''</div>'''
+    def tpm_perbiotype_streaming(self, tpm_path, biotype, chunk_size):
+        annotated = set(biotype.gene_biotype.dropna().astype(str))
+        biotypes = sorted(annotated | {'NA'})
 
+        dist = None
+        for chunk in iter_gene_table_chunks(tpm_path, chunk_size):
+            if dist is None:
+                dist = BiotypeDistributions(biotypes, list(chunk))
+            # genes annotated with an empty biotype are dropped
+            chunk = chunk.assign(biotype=gene_biotypes(biotype, chunk.index).values).dropna()
+            codes = pd.Categorical(chunk.pop('biotype'), categories=biotypes).codes
+            dist.add(codes, chunk.values)
 
+        self.add_biotype_box_section(dist.box_stats())
 
+    def add_biotype_box_section(self, stats, outliers=None):
         self.add_section (
             name = 'TPM per biotype',
             anchor = 'TPM_per_biotype',
-            content = html_string
-        )
\ No newline at end of file
+            content = biotype_box_plot('bcbio_rnaseq_qc-tpm_per_biotype', stats, outliers)
+        )
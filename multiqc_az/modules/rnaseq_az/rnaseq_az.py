@@ -2,6 +2,9 @@
 
 """ MultiQC module to add link to Bcl2fastq reports """
 
+import io
+import re
+import gzip
 import logging
 from os.path import join
 
@@ -9,60 +12,65 @@ from multiqc.modules.base_module import BaseMultiqcModule
 from multiqc import config
 from multiqc.plots import scatter
 
-from ngs_utils.file_utils import remove_quotes
+from multiqc_az.utils import assign_colors, lazy_import
+from multiqc_az.profiling import profiled, count_input
 
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 # Initialise the logger
 log = logging.getLogger(__name__.replace('multiqc_az', 'multiqc'))
 
 
-standard_colors = [
-    '#0000FF',
-    '#008000',
-    '#FFA500',
-    '#FF00FF',
-    '#CCCC00',
-    '#800000',
-    '#00CCCC',
-    '#808080',
-    '#800080',
-    '#808000',
-    '#000080',
-    '#008080',
-    '#00FF00',
-]
+def read_text(fpath):
+    """ Contents of a plain or gzipped text file """
+    count_input(fpath)
+    with open(fpath, 'rb') as f:
+        data = f.read()
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    return data.decode('utf-8')
 
-def parse_pca_data(pca_fpath):
-    pca_data = dict()
-    color_by_sample = dict()
-    color_by_cond = dict()
-    conditions = []
-    variances = []
-    with open(pca_fpath) as f:
-        for i, l in enumerate(f):
-            if i == 0:
-                continue
-            if l.startswith('#'):
-                variances = l.split(':')[1].split(',')
-                continue
-            name, pc1, pc2, group, condition, name = [remove_quotes(field) for field in l.split()]
-            pc1 = float(pc1)
-            pc2 = float(pc2)
-            pca_data[name] = [{
-                'x': pc1,
-                'y': pc2,
-                'name': name
-            }]
-            if condition not in conditions:
-                conditions.append(condition)
-            color_by_cond[condition] = color_by_sample[name] = standard_colors[conditions.index(condition) % len(standard_colors)]
-
-        if len(pca_data) == 0:
-            log.debug("Couldn't parse contents of PCA data file {}".format(f['fn']))
-            return None
-    return pca_data, color_by_sample, color_by_cond, variances
+
+def parse_variances(text):
+    """ Percent of variance per PC from the '#variance: 45.3,20.1' comment line, if any """
+    for l in re.findall(r'^#.*:(.*)$', text, re.MULTILINE):
+        try:
+            return [float(v.strip().strip('"\'%')) for v in l.split(',') if v.strip()]
+        except ValueError:
+            continue
+    return []
 
 
+def parse_pca_data(pca_fpath):
+    """ Parses pca_data.txt (optionally gzipped): a whitespace separated table with quoted fields,
+    the sample in the first column, any number of PC1..PCn columns, and a variance comment line.
+    Returns a frame indexed by sample with float pc1..pcn columns and a condition column,
+    in the shape bcbio_rnaseq_qc.pca_traces() takes, and the list of variances. """
+    text = read_text(pca_fpath)
+    try:
+        table = pd.read_csv(io.StringIO(text), sep=r'\s+', comment='#', quotechar='"')
+    except (ValueError, pd.errors.ParserError) as e:
+        log.warning("Couldn't parse contents of PCA data file {}: {}".format(pca_fpath, e))
+        return None
+
+    pcs = [c for c in table.columns if re.match(r'^pc\d+$', str(c), re.IGNORECASE)]
+    if len(table) == 0 or len(pcs) < 2:
+        log.debug("Couldn't parse contents of PCA data file {}".format(pca_fpath))
+        return None
+
+    pca_data = pd.DataFrame({c.lower(): pd.to_numeric(table[c], errors='coerce').astype(np.float64) for c in pcs})
+    pca_data['condition'] = table['condition'].astype(str).values if 'condition' in table.columns else 'samples'
+    names = table['name'] if 'name' in table.columns else table.index
+    pca_data.index = pd.Index(names.astype(str), name='sample')
+    return pca_data, parse_variances(text)
+
+
+def axis_label(pc, variances, i):
+    return '{}: {:g}% variance'.format(pc, variances[i]) if i < len(variances) else pc
+
+
+@profiled()
 class MultiqcModule(BaseMultiqcModule):
     def __init__(self):
         # Initialise the parent object
@@ -80,8 +88,14 @@ class MultiqcModule(BaseMultiqcModule):
         rnaseq_pca_file = rnaseq_pca_files[0]
         pca_dirpath, pca_fname = rnaseq_pca_file['root'], rnaseq_pca_file['fn']
         pca_fpath = join(pca_dirpath, pca_fname)
-        pca_data, color_by_sample, color_by_cond, variances = parse_pca_data(pca_fpath)
-        pca_data = self.ignore_samples(pca_data)
+        parsed = parse_pca_data(pca_fpath)
+        if parsed is None:
+            raise UserWarning
+        pca_data, variances = parsed
+        color_by_cond = assign_colors(pca_data['condition'])
+        color_by_sample = dict(zip(pca_data.index, pca_data['condition'].map(color_by_cond)))
+        plot_data = self.ignore_samples({name: [{'x': x, 'y': y, 'name': name}] for name, x, y in
+                                         zip(pca_data.index, pca_data['pc1'].tolist(), pca_data['pc2'].tolist())})
 
         description = ("<p>PCA is a popular method that is based on the principles of dimensional reduction. "
             "Below is a PCA plot of the samples within the space of the first two principal components that explain the most variation in the data. "
@@ -105,10 +119,10 @@ class MultiqcModule(BaseMultiqcModule):
         self.add_section(
             name='Principal Components Analysis',
             anchor='rnaseq_az-pca',
-            content=description + legend + scatter.plot(pca_data, {
+            content=description + legend + scatter.plot(plot_data, {
                 'title': 'Principal Components Analysis',
-                'xlab': 'PC1: ' + variances[0] + '% variance',
-                'ylab': 'PC2: ' + variances[1] + '% variance',
+                'xlab': axis_label('PC1', variances, 0),
+                'ylab': axis_label('PC2', variances, 1),
                 'colors': color_by_sample,
                 'tt_label': 'PC1: {point.x}<br/>PC2: {point.y}',
             })
@@ -2,30 +2,92 @@
 """ MultiQC hook functions - we tie into the MultiQC
 core here to add in extra functionality. """
 
+import os
+import re
+import json
+import hashlib
 import logging
 import yaml
-from os.path import join, dirname
+from os.path import join, dirname, expanduser
 from multiqc.utils import report, config
-
-from pkg_resources import get_distribution
-__version__ = get_distribution("multiqc_az").version
+from multiqc_az.plotly_assets import plotlyjs_html
+from multiqc_az.profiling import profiled
+from multiqc_az import __version__
 
 log = logging.getLogger('multiqc.multiqc_az')
 
 
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def config_cache_dir():
+    return join(os.environ.get('XDG_CACHE_HOME') or join(expanduser('~'), '.cache'), 'multiqc_az')
+
+
+def load_plugin_config(fpath):
+    """ Parsed plugin config, cached as JSON keyed on the hash of the YAML file """
+    with open(fpath, 'rb') as f:
+        data = f.read()
+    cache_fpath = join(config_cache_dir(), 'multiqc_config.' + hashlib.sha1(data).hexdigest() + '.json')
+    try:
+        with open(cache_fpath) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        pass
+
+    cfg = yaml.load(data, Loader=yaml_loader)
+    try:
+        if not os.path.isdir(config_cache_dir()):
+            os.makedirs(config_cache_dir())
+        tmp_fpath = cache_fpath + '.tmp' + str(os.getpid())
+        with open(tmp_fpath, 'w') as f:
+            json.dump(cfg, f)
+        os.rename(tmp_fpath, cache_fpath)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        log.debug('Could not cache plugin config in {}: {}'.format(config_cache_dir(), e))
+    return cfg
+
+
+def read_sample_map(fpath):
+    """ {sample: value} from a JSON object, or from a TSV file with a sample and a value
+    per line (an empty value becomes None) """
+    with open(fpath) as f:
+        if fpath.endswith('.json'):
+            return json.load(f)
+        sample_map = dict()
+        for l in f:
+            if not l.strip() or l.startswith('#'):
+                continue
+            fields = l.rstrip('\r\n').split('\t')
+            sample_map[fields[0]] = fields[1] if len(fields) > 1 and fields[1] else None
+        return sample_map
+
+
+def load_sample_maps(az_conf):
+    """ Large per-sample maps can be given as az.<name>_file instead of inline;
+    entries given inline take precedence """
+    for name in ['ngs_report_by_sample', 'gender_by_sample']:
+        fpath = az_conf.get(name + '_file')
+        if fpath:
+            sample_map = read_sample_map(fpath)
+            sample_map.update(az_conf.get(name) or {})
+            az_conf[name] = sample_map
+
+
 class config_loaded:
     def __init__(self):
         log.debug("Running config_loaded hook v{}. Loading specific settings and metadata".format(__version__))
 
-        with open(join(dirname(__file__), 'multiqc_config.yaml')) as f:
-            cfg = yaml.load(f)
+        cfg = load_plugin_config(join(dirname(__file__), 'multiqc_config.yaml'))
         config.update_dict(config.__dict__, cfg)
 
 
+@profiled()
 class execution_start:
     def __init__(self):
         az_conf = config.__dict__.get('az')
         if az_conf:
+            load_sample_maps(az_conf)
             report.az = az_conf
             if az_conf.get('is_rnaseq', False) is True:
                 config.table_columns_visible['bcbio']['Mapped_reads'] = True
@@ -43,6 +105,7 @@ general_stats_descriptions = {
 }
 
 
+@profiled()
 class before_set_general_stats_html:
     def __init__(self):
         for header in report.general_stats_headers:
@@ -71,36 +134,54 @@ class before_set_general_stats_html:
                 if list(d.keys())[0] != 'Target for var. calling:']
 
 
+text_node_re = re.compile(r'>([^<>]+)<')
+
+
+def link_sample_names(html, url_by_sample):
+    """ Wraps every text node that is exactly a sample name into a link, in a single pass over the html """
+    def _link(m):
+        url = url_by_sample.get(m.group(1))
+        return m.group(0) if url is None else '><a href="' + url + '">' + m.group(1) + '</a><'
+    return text_node_re.sub(_link, html)
+
+
+beeswarm_docs_url = 'http://multiqc.info/docs/#tables--beeswarm-plots'
+
+
+def beeswarm_note_html(num_samples):
+    """ Replacement for the MultiQC beeswarm note, pointing to the sample index below the plot """
+    return ('<p class="text-muted"><span class="glyphicon glyphicon-exclamation-sign" '
+            'data-toggle="tooltip"></span> A <a href="' + beeswarm_docs_url + '"> '
+            'beeswarm</a> plot has been generated instead because of the large number of samples. '
+            'Showing {} samples, use the sample index below to open their reports.</p>').format(num_samples)
+
+
+def sample_index_json(url_by_sample):
+    """ [sample, url] pairs for the sample_index.html component, safe to embed in a <script> tag """
+    return json.dumps([[sname, url] for sname, url in url_by_sample.items()]).replace('</', '<\\/')
+
+
+@profiled(write=True)
 class after_set_general_stats_html:
     def __init__(self):
+        if getattr(report, 'az_plotlyjs_required', False):
+            report.az_plotlyjs_html = plotlyjs_html()
+
         az_conf = config.__dict__.get('az')
         if az_conf and 'ngs_report_by_sample' in az_conf:
             log.info('Adding NGS repots links')
-            for sname in az_conf['ngs_report_by_sample']:
-                if az_conf['ngs_report_by_sample'][sname] is not None:
-                    report.general_stats_html = report.general_stats_html \
-                        .replace(
-                            '>' + sname + '<',
-                            '><a href="' + az_conf['ngs_report_by_sample'][sname] + '">' + sname + '</a><')
+            report.general_stats_html = link_sample_names(
+                report.general_stats_html,
+                {sname: url for sname, url in az_conf['ngs_report_by_sample'].items() if url is not None})
             report.ngs_reports_added = True
 
             if len(az_conf['ngs_report_by_sample'].items()) >= config.max_table_rows:
-                new_general_stats_html = ''
-                for l in report.general_stats_html.split('\n'):
-                    if 'http://multiqc.info/docs/#tables--beeswarm-plots' in l:
-                        l = ('<p class="text-muted"><span class="glyphicon glyphicon-exclamation-sign" '
-                             'data-toggle="tooltip"></span> A <a href="http://multiqc.info/docs/#tables--beeswarm-plots"> '
-                             'beeswarm</a> plot has been generated instead because of the large number of samples. '
-                             'Showing {} samples:<br>').format(len(az_conf['ngs_report_by_sample']))
-                        sample_lines = []
-                        for sname in az_conf['ngs_report_by_sample']:
-                            if az_conf['ngs_report_by_sample'][sname] is not None:
-                                sample_lines.append('<a href="' + az_conf['ngs_report_by_sample'][sname] + '">' + sname + '</a>')
-                            else:
-                                sample_lines.append(' <span>' + sname + '</span>')
-                        l += ',&nbsp'.join(sample_lines) + '</p>'
-                    new_general_stats_html += l
-                report.general_stats_html = new_general_stats_html
+                lines = report.general_stats_html.split('\n')
+                for i, l in enumerate(lines):
+                    if beeswarm_docs_url in l:
+                        lines[i] = beeswarm_note_html(len(az_conf['ngs_report_by_sample']))
+                report.general_stats_html = '\n'.join(lines)
+                report.az_sample_index_json = sample_index_json(az_conf['ngs_report_by_sample'])
                 report.beeswarm_renderred = True
 
                 # TODO beeswarm plot:
@@ -0,0 +1,69 @@
+""" Shared plotly.js bundle for the plugin sections.
+
+Sections emit an empty plot div, their figure data as JSON in a
+<script type="application/json"> tag (to_json()), and a small switcher script
+that draws the figure with Plotly.react and redraws it when another sample,
+contrast or PC is selected. They call require_plotlyjs(), and the
+before_report_generation hook then adds the bundle once to the az template
+header, either inline (minified) or as gzip + base64 decoded in the browser
+(az.plotlyjs: inline | gzip). Switcher code is queued with mqcAzPlotly() until
+the bundle is ready. """
+
+import json
+import gzip
+import base64
+
+from multiqc.utils import report
+
+from multiqc_az.utils import get_az_config, lazy_import
+
+py = lazy_import('plotly')
+
+
+ready_queue_js = '''
+window.mqcAzPlotlyQueue = [];
+window.mqcAzPlotly = function(fn) {
+    if (window.mqcAzPlotlyQueue === null) { fn(); } else { window.mqcAzPlotlyQueue.push(fn); }
+};
+window.mqcAzPlotlyLoaded = function() {
+    var queue = window.mqcAzPlotlyQueue;
+    window.mqcAzPlotlyQueue = null;
+    queue.forEach(function(fn) { fn(); });
+};
+'''
+
+gzip_loader_js = '''
+(function() {
+    var bytes = Uint8Array.from(atob(document.getElementById("mqc_az_plotlyjs").textContent.trim()),
+                                function(c) { return c.charCodeAt(0); });
+    var stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("gzip"));
+    new Response(stream).text().then(function(code) {
+        var script = document.createElement("script");
+        script.text = code;
+        document.head.appendChild(script);
+        window.mqcAzPlotlyLoaded();
+    });
+})();
+'''
+
+
+def require_plotlyjs():
+    report.az_plotlyjs_required = True
+
+
+def to_json(obj):
+    """ JSON safe to embed in a <script> tag """
+    return json.dumps(obj, cls=py.utils.PlotlyJSONEncoder).replace('</', '<\\/')
+
+
+def plotlyjs_html():
+    """ The plotly.js bundle and the mqcAzPlotly() ready queue, for the template header """
+    bundle = py.offline.get_plotlyjs()
+    if get_az_config('plotlyjs', 'inline') == 'gzip':
+        encoded = base64.b64encode(gzip.compress(bundle.encode('utf-8'))).decode('ascii')
+        return '<script>' + ready_queue_js + '</script>' + \
+            '<script type="text/plain" id="mqc_az_plotlyjs">' + encoded + '</script>' + \
+            '<script>' + gzip_loader_js + '</script>'
+    return '<script>' + ready_queue_js + '</script>' + \
+        '<script type="text/javascript">' + bundle + '</script>' + \
+        '<script> window.mqcAzPlotlyLoaded(); </script>'
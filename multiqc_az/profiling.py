@@ -0,0 +1,156 @@
+""" Time and memory profile of the plugin hooks, RNA-seq modules and their sections.
+
+Classes decorated with @profiled() append a record per hook run, module __init__ and
+add_section call: wall and CPU time, peak RSS of the process, bytes of the input files
+read (counted by the readers with count_input()), and bytes of HTML emitted. The hook decorated with write=True saves
+the records to multiqc_az_profile.json in the output directory, and with az.profile: true
+they are also shown as a table at the end of the report. """
+
+import os
+import sys
+import json
+import time
+import logging
+import functools
+import threading
+from os.path import join
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from multiqc.utils import report, config
+
+from multiqc_az.utils import get_az_config
+
+log = logging.getLogger('multiqc.multiqc_az')
+
+profile_fn = 'multiqc_az_profile.json'
+
+records = []
+_active = []
+_lock = threading.Lock()
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def add_input_bytes(nbytes):
+    """ Adds to the input bytes of the innermost profiled code """
+    if _active:
+        with _lock:
+            _active[-1]['input_bytes'] += nbytes
+
+
+def count_input(fpath):
+    """ Counts the size of an input file read by the profiled code """
+    try:
+        add_input_bytes(os.path.getsize(fpath))
+    except OSError:
+        pass
+
+
+class input_counter(object):
+    """ Context manager collecting the input bytes of the enclosed code into its own
+    {'input_bytes': n}, for tasks that may run in worker processes: the task returns
+    the count and the caller adds it with add_input_bytes(). """
+    def __enter__(self):
+        self.record = {'name': None, 'input_bytes': 0, 'html_bytes': 0}
+        _active.append(self.record)
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active.remove(self.record)
+        return False
+
+
+class measure(object):
+    """ Context manager appending a profile record for the enclosed code.
+    Input and HTML bytes of nested records are added to the enclosing one. """
+    def __init__(self, kind, name):
+        self.record = {'kind': kind, 'name': name, 'parent': _active[-1]['name'] if _active else None,
+                       'input_bytes': 0, 'html_bytes': 0}
+
+    def __enter__(self):
+        self.start = time.perf_counter(), time.process_time(), peak_rss_mb()
+        _active.append(self.record)
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active.pop()
+        wall, cpu, rss = self.start
+        end_rss = peak_rss_mb()
+        self.record.update({
+            'status': 'ok' if exc_type is None else exc_type.__name__,
+            'wall_s': round(time.perf_counter() - wall, 4),
+            'cpu_s': round(time.process_time() - cpu, 4),
+            'peak_rss_mb': None if end_rss is None else round(end_rss, 1),
+            'peak_rss_increase_mb': None if end_rss is None else round(end_rss - rss, 1),
+        })
+        records.append(self.record)
+        if _active:
+            _active[-1]['input_bytes'] += self.record['input_bytes']
+            _active[-1]['html_bytes'] += self.record['html_bytes']
+        return False
+
+
+def _profile_module(cls):
+    add_section = cls.add_section
+
+    @functools.wraps(add_section)
+    def profiled_add_section(self, *args, **kwargs):
+        with measure('section', kwargs.get('name') or kwargs.get('anchor')) as record:
+            add_section(self, *args, **kwargs)
+            record['html_bytes'] = sum(len(str(kwargs.get(k) or ''))
+                                       for k in ['description', 'helptext', 'plot', 'content'])
+
+    cls.add_section = profiled_add_section
+
+
+def profiled(write=False):
+    """ Class decorator for hooks and modules, profiling their __init__. For modules,
+    add_section calls are recorded too.
+    With write=True the profile is saved once the decorated hook is done. """
+    def decorate(cls):
+        is_module = hasattr(cls, 'add_section')
+        name = cls.__module__.split('.')[-1] if is_module else cls.__name__
+        init = cls.__init__
+
+        @functools.wraps(init)
+        def profiled_init(self, *args, **kwargs):
+            try:
+                with measure('module' if is_module else 'hook', name):
+                    init(self, *args, **kwargs)
+            finally:
+                if write:
+                    write_profile()
+
+        cls.__init__ = profiled_init
+        if is_module:
+            _profile_module(cls)
+        return cls
+    return decorate
+
+
+def write_profile():
+    """ Saves the records next to the report, and exposes them to the template with az.profile: true """
+    if get_az_config('profile', False):
+        report.az_profile = records
+
+    output_dir = getattr(config, 'output_dir', None)
+    if not output_dir:
+        return
+    try:
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        with open(join(output_dir, profile_fn), 'w') as f:
+            json.dump({'records': records}, f, indent=2)
+        log.debug('Saved plugin profile to {}'.format(join(output_dir, profile_fn)))
+    except (IOError, OSError) as e:
+        log.warning('Could not save plugin profile: {}'.format(e))
@@ -1,5 +1,25 @@
 from __future__ import division
 import os
+import sys
+import importlib
+from multiqc.utils import config
+
+
+standard_colors = [
+    '#0000FF',
+    '#008000',
+    '#FFA500',
+    '#FF00FF',
+    '#CCCC00',
+    '#800000',
+    '#00CCCC',
+    '#808080',
+    '#800080',
+    '#808000',
+    '#000080',
+    '#008080',
+    '#00FF00',
+]
 
 
 def format_decimal(value, unit=None):
@@ -31,3 +51,35 @@ def format_bed_info(d, genome_info):
             html += ', {genes} gene' + ('s' if d.get('genes') != 1 else '')
         html += ')'
     return html.format(**locals())
+
+
+def get_az_config(key, default=None):
+    az_conf = config.__dict__.get('az') or {}
+    value = az_conf.get(key)
+    return default if value is None else value
+
+
+def assign_colors(keys, colors=standard_colors):
+    """ Colour per distinct key, cycling through colors in order of first appearance """
+    color_by_key = dict()
+    for key in keys:
+        if key not in color_by_key:
+            color_by_key[key] = colors[len(color_by_key) % len(colors)]
+    return color_by_key
+
+
+class LazyModule(object):
+    """ Imports the module on first attribute access """
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name)
+        self.__dict__.update(vars(module))
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """ Keeps heavy dependencies (numpy, pandas, plotly) out of the plugin import:
+    MultiQC loads every module on each run, even when it has no input files """
+    return sys.modules[name] if name in sys.modules else LazyModule(name)
@@ -25,7 +25,8 @@ setup(
     install_requires = [
         'simplejson',
         'pyyaml',
-        'plotly'
+        'plotly>=4.6',
+        'importlib_metadata; python_version < "3.8"',
     ],
     entry_points = {
         'multiqc.modules.v1': [